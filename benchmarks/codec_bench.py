@@ -0,0 +1,58 @@
+"""
+Microbenchmark for posts.codec, comparing the per-request cost of validating
+and serializing posts against the jsonschema.validate/as_dictionary/json.dumps
+path it replaced.
+
+    python benchmarks/codec_bench.py [--posts 100] [--repeat 1000]
+"""
+import os
+import sys
+import json
+import timeit
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("CONFIG_PATH", "posts.config.TestingConfig")
+
+from jsonschema import validate
+
+from posts import codec, models
+
+def measure(func, repeat):
+    """ Best time per call of func, in microseconds """
+    times = timeit.repeat(func, number=repeat, repeat=3)
+    return min(times) / repeat * 1e6
+
+def report(name, before, after):
+    print("{:<24} {:>10.1f}us {:>10.1f}us {:>8.1f}x".format(
+        name, before, after, before / after))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--posts", type=int, default=100,
+                        help="number of posts in each serialized listing")
+    parser.add_argument("--repeat", type=int, default=1000,
+                        help="number of calls timed for each measurement")
+    args = parser.parse_args()
+
+    data = {"title": "Example Post", "body": "Just a test " * 20}
+    rows = [(i, "Example Post {}".format(i), data["body"])
+            for i in range(args.posts)]
+    posts = [models.Post(id=id, title=title, body=body)
+             for id, title, body in rows]
+
+    print("JSON backend: {}".format(codec.dumps.__module__))
+    print("{:<24} {:>12} {:>12} {:>9}".format("", "before", "after", "speedup"))
+    report("validate post",
+           measure(lambda: validate(data, codec.post_schema), args.repeat),
+           measure(lambda: codec.post_validator.validate(data), args.repeat))
+    report("serialize post",
+           measure(lambda: json.dumps(posts[0].as_dictionary()), args.repeat),
+           measure(lambda: codec.dump_post(rows[0]), args.repeat))
+    report("serialize {} posts".format(args.posts),
+           measure(lambda: json.dumps([post.as_dictionary() for post in posts]),
+                   args.repeat),
+           measure(lambda: codec.dump_posts(rows), args.repeat))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+"""
+Load test for the posts API. Seeds a database with posts, serves the app on
+a local port, drives every route in posts/api.py from concurrent clients and
+reports latency percentiles, throughput and peak RSS for each.
+
+    python benchmarks/load_bench.py --posts 10000 --concurrency 8
+    python benchmarks/load_bench.py --save-baseline
+    python benchmarks/load_bench.py --baseline benchmarks/baseline.json
+
+With --baseline the run fails if any route's p95 latency or throughput, or
+the peak RSS, is worse than the baseline by more than --tolerance.
+"""
+import os
+import sys
+import json
+import time
+import random
+import httplib
+import resource
+import argparse
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--database-uri", default="sqlite:///bench.db",
+                        help="database to seed and serve from, SQLite or Postgres")
+    parser.add_argument("--posts", type=int, default=1000,
+                        help="number of posts to seed, from 1k up to 10M")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="number of clients making requests at once")
+    parser.add_argument("--requests", type=int, default=500,
+                        help="number of requests made to each route")
+    parser.add_argument("--full-scan-limit", type=int, default=100000,
+                        help="skip the unpaginated listing above this many posts")
+    parser.add_argument("--baseline", help="baseline results to compare against")
+    parser.add_argument("--save-baseline", nargs="?", const=DEFAULT_BASELINE,
+                        help="save the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed fraction by which a result may be worse")
+    return parser.parse_args()
+
+def seed(session, models, count, chunk_size=10000):
+    """ Top the posts table up to count posts """
+    posts = models.Post.__table__
+    existing = session.query(models.Post).count()
+    body = "Just a test post, with a body long enough to be realistic. " * 8
+    for start in range(existing, count, chunk_size):
+        rows = [{"title": "Example Post {}".format(i), "body": body, "version": 1}
+                for i in range(start, min(start + chunk_size, count))]
+        session.execute(posts.insert(), rows)
+        models.adjust_post_count(session, len(rows))
+        session.commit()
+    session.remove()
+
+def percentile(values, fraction):
+    """ Nearest rank percentile of a sorted list """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+class Client(object):
+    """ Makes requests to the server over one keep-alive connection """
+    def __init__(self, port):
+        self.connection = httplib.HTTPConnection("127.0.0.1", port)
+
+    def request(self, method, path, body=None, content_type="application/json"):
+        headers = {"Accept": "application/json"}
+        if body is not None:
+            headers["Content-Type"] = content_type
+        self.connection.request(method, path, body, headers)
+        response = self.connection.getresponse()
+        data = response.read()
+        if response.getheader("connection") == "close" or response.version < 11:
+            self.connection.close()
+        return response.status, response.getheader("location"), data
+
+def run_scenario(port, make_request, requests, concurrency):
+    """
+    Make requests through make_request from concurrent clients, returning the
+    sorted latencies, the number of errors and the wall time taken
+    """
+    latencies = []
+    errors = [0]
+    remaining = [requests]
+    lock = threading.Lock()
+
+    def worker():
+        client = Client(port)
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            start = time.time()
+            try:
+                status = make_request(client)
+            except (httplib.HTTPException, IOError):
+                status = 599
+            elapsed = time.time() - start
+            with lock:
+                latencies.append(elapsed)
+                if status >= 400:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sorted(latencies), errors[0], time.time() - start
+
+def scenarios(args, max_id):
+    """ The requests made to each route, as (name, requests, function) """
+    created = []
+    created_lock = threading.Lock()
+    post = json.dumps({"title": "Benchmark Post", "body": "Just a benchmark"})
+    bulk = json.dumps([{"op": "create", "title": "Bulk Post", "body": "Just a test"}
+                       for i in range(100)])
+
+    def posts_get(client):
+        return client.request("GET", "/api/posts?limit=50")[0]
+
+    def posts_get_all(client):
+        return client.request("GET", "/api/posts")[0]
+
+    def posts_get_title(client):
+        return client.request("GET", "/api/posts?title_like=Post+1&limit=50")[0]
+
+    def posts_get_search(client):
+        return client.request("GET", "/api/posts?q=example&limit=50")[0]
+
+    def posts_count(client):
+        return client.request("GET", "/api/posts/_count")[0]
+
+    def posts_count_title(client):
+        return client.request("GET", "/api/posts/_count?title_like=Post+1")[0]
+
+    def post_get(client):
+        id = random.randint(1, max_id)
+        return client.request("GET", "/api/posts/{}".format(id))[0]
+
+    def posts_post(client):
+        status, location, data = client.request("POST", "/api/posts", post)
+        if location:
+            with created_lock:
+                created.append(location.rsplit("/", 1)[-1])
+        return status
+
+    def posts_edit(client):
+        id = random.randint(1, max_id)
+        return client.request("PUT", "/api/post/{}".format(id), post)[0]
+
+    def post_delete(client):
+        with created_lock:
+            id = created.pop() if created else None
+        if id is None:
+            return 200
+        return client.request("DELETE", "/api/posts/{}".format(id))[0]
+
+    def posts_bulk(client):
+        return client.request("POST", "/api/posts/_bulk", bulk)[0]
+
+    def posts_changes(client):
+        # A consumer catching up reads a whole page of the feed at a time
+        return client.request("GET", "/api/posts/_changes?since=0")[0]
+
+    def cache_stats(client):
+        return client.request("GET", "/api/cache")[0]
+
+    result = [
+        ("posts_get page", args.requests, posts_get),
+        ("posts_get title_like", args.requests, posts_get_title),
+        ("posts_get q", args.requests, posts_get_search),
+        ("posts_count", args.requests, posts_count),
+        ("posts_count title_like", args.requests, posts_count_title),
+        ("post_get", args.requests, post_get),
+        ("posts_post", args.requests, posts_post),
+        ("posts_edit", args.requests, posts_edit),
+        ("post_delete", args.requests, post_delete),
+        ("posts_bulk", max(1, args.requests // 10), posts_bulk),
+        # After the writes, so that there are changes to read
+        ("posts_changes", args.requests, posts_changes),
+        ("cache_stats", args.requests, cache_stats)
+    ]
+    if args.posts <= args.full_scan_limit:
+        result.insert(1, ("posts_get all", max(1, args.requests // 10), posts_get_all))
+    return result
+
+def compare(results, baseline, tolerance):
+    """ Regressions of results against the baseline, as messages """
+    regressions = []
+    for name, result in sorted(results["routes"].items()):
+        before = baseline["routes"].get(name)
+        if not before:
+            continue
+        if result["p95"] > before["p95"] * (1 + tolerance):
+            regressions.append("{}: p95 {:.1f}ms, baseline {:.1f}ms".format(
+                name, result["p95"], before["p95"]))
+        if result["throughput"] < before["throughput"] * (1 - tolerance):
+            regressions.append("{}: {:.1f} req/s, baseline {:.1f} req/s".format(
+                name, result["throughput"], before["throughput"]))
+    if results["peak_rss"] > baseline["peak_rss"] * (1 + tolerance):
+        regressions.append("peak RSS {}KB, baseline {}KB".format(
+            results["peak_rss"], baseline["peak_rss"]))
+    return regressions
+
+def main():
+    args = parse_args()
+
+    # Point the app at the benchmark database before it is imported
+    os.environ["CONFIG_PATH"] = "posts.config.BenchmarkConfig"
+    os.environ["BENCH_DATABASE_URI"] = args.database_uri
+    from werkzeug.serving import make_server, WSGIRequestHandler
+    from posts import create_app, models
+    from posts.database import engine, session
+    from posts.migrations import migrate
+
+    app = create_app()
+    with app.app_context():
+        migrate(engine)
+        print("Seeding {} posts into {}".format(args.posts, args.database_uri))
+        seed(session, models, args.posts)
+
+    class QuietRequestHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_server("127.0.0.1", 0, app, threaded=True,
+                         request_handler=QuietRequestHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    results = {"posts": args.posts, "concurrency": args.concurrency, "routes": {}}
+    print("{:<22} {:>9} {:>9} {:>9} {:>10} {:>7}".format(
+        "route", "p50 ms", "p95 ms", "p99 ms", "req/s", "errors"))
+    for name, requests, make_request in scenarios(args, args.posts):
+        latencies, errors, elapsed = run_scenario(server.server_port, make_request,
+                                                  requests, args.concurrency)
+        result = {
+            "p50": percentile(latencies, 0.50) * 1000,
+            "p95": percentile(latencies, 0.95) * 1000,
+            "p99": percentile(latencies, 0.99) * 1000,
+            "throughput": len(latencies) / elapsed,
+            "errors": errors
+        }
+        results["routes"][name] = result
+        print("{:<22} {p50:>9.1f} {p95:>9.1f} {p99:>9.1f} {throughput:>10.1f} "
+              "{errors:>7}".format(name, **result))
+
+    server.shutdown()
+    # ru_maxrss is in kilobytes on Linux, and covers the server and clients
+    results["peak_rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print("Peak RSS: {}KB".format(results["peak_rss"]))
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+        print("Saved baseline to {}".format(args.save_baseline))
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print("REGRESSION {}".format(regression))
+        if regressions:
+            sys.exit(1)
+        print("No regressions against {}".format(args.baseline))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Startup benchmark for the posts app. Each run starts a fresh Python process
+which imports posts, builds the app with create_app and serves its first
+request, and reports how long each of those took.
+
+    python benchmarks/startup_bench.py [--runs 10] [--database-uri sqlite:///bench.db]
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# Run in each child process, so that every import is a cold one
+CHILD = """
+import time
+start = time.time()
+import posts
+imported = time.time()
+app = posts.create_app()
+created = time.time()
+response = app.test_client().get("/api/posts?limit=10",
+                                 headers=[("Accept", "application/json")])
+served = time.time()
+assert response.status_code == 200, response.status_code
+print('{{"import": {}, "create_app": {}, "first_request": {}}}'.format(
+    imported - start, created - imported, served - created))
+"""
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10,
+                        help="number of processes started")
+    parser.add_argument("--database-uri", default="sqlite:///bench.db",
+                        help="database the app is pointed at")
+    args = parser.parse_args()
+
+    env = dict(os.environ, CONFIG_PATH="posts.config.BenchmarkConfig",
+               BENCH_DATABASE_URI=args.database_uri)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [ROOT] + [path for path in [env.get("PYTHONPATH")] if path])
+
+    # Bring the database up to date first, so no run pays for migrations
+    subprocess.check_call([sys.executable, "-m", "posts.migrations"],
+                          env=env, cwd=ROOT)
+
+    runs = []
+    for i in range(args.runs):
+        output = subprocess.check_output([sys.executable, "-c", CHILD],
+                                         env=env, cwd=ROOT)
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+
+    print("{:<16} {:>10} {:>10} {:>10}".format("phase", "min ms", "median ms",
+                                               "max ms"))
+    for phase in ["import", "create_app", "first_request"]:
+        times = [run[phase] * 1000 for run in runs]
+        print("{:<16} {:>10.1f} {:>10.1f} {:>10.1f}".format(
+            phase, min(times), median(times), max(times)))
+    totals = [sum(run.values()) * 1000 for run in runs]
+    print("{:<16} {:>10.1f} {:>10.1f} {:>10.1f}".format(
+        "total", min(totals), median(totals), max(totals)))
+
+if __name__ == "__main__":
+    main()
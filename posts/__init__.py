@@ -2,12 +2,35 @@ import os
 
 from flask import Flask
 
-app = Flask(__name__)
-config_path = os.environ.get("CONFIG_PATH", "posts.config.DevelopmentConfig")
-app.config.from_object(config_path)
+def create_app(config_path=None):
+    """
+    Build an app configured from config_path, or from the CONFIG_PATH
+    environment variable. The modules behind the routes are imported here
+    rather than with the package, and nothing connects to the database until
+    a request needs it.
+    """
+    app = Flask(__name__)
+    if config_path is None:
+        config_path = os.environ.get("CONFIG_PATH", "posts.config.DevelopmentConfig")
+    app.config.from_object(config_path)
 
-import api
-
-from database import Base, engine
-Base.metadata.create_all(engine)
+    import api
+    import cache
+    import database
+    import sharding
+    import writeback
+    import repository
+    import ratelimit
+    import compression
+    import instrumentation
 
+    database.init_app(app)
+    sharding.init_app(app)
+    repository.init_app(app)
+    cache.init_app(app)
+    writeback.init_app(app)
+    instrumentation.init_app(app)
+    ratelimit.init_app(app)
+    compression.init_app(app)
+    app.register_blueprint(api.blueprint)
+    return app
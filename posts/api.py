@@ -1,86 +1,410 @@
-import json
+import base64
+import hashlib
+import time
+from itertools import islice
 
-from flask import request, Response, url_for
-from jsonschema import validate, ValidationError
+from flask import (Blueprint, request, Response, current_app, url_for,
+                   stream_with_context, g)
+from jsonschema import ValidationError
 
-import models
+import codec
 import decorators
-from posts import app
+import instrumentation
 from database import session
+import compression
+from repository import Conflict, repository
+from cache import cache, post_key, invalidate_post
+from writeback import writes, QueueFull
 
-# JSON Schema describing the structure of a post
-post_schema = {
-    "properties": {
-        "title" : {"type" : "string"},
-        "body": {"type": "string"}
-    },
-    "required": ["title", "body"]
-}
+# The post routes, registered on an app by create_app
+blueprint = Blueprint("api", __name__)
 
-@app.route("/api/posts", methods=["GET"])
-@decorators.accept("application/json")
+def requested_fields():
+    """
+    The post fields the client asked for with ?fields=, or all of them.
+    Raises a ValueError if it asked for one which doesn't exist.
+    """
+    fields = request.args.get("fields")
+    if not fields:
+        return codec.POST_FIELDS
+    fields = tuple(fields.split(","))
+    for field in fields:
+        if field not in codec.POST_FIELDS + ("body_preview",):
+            raise ValueError("Unknown field {}".format(field))
+    return fields
+
+def search_query():
+    """
+    The terms the client searched for with ?q=, or None. A blank search is
+    no search at all, rather than an empty full text query, which the
+    database would refuse.
+    """
+    return request.args.get("q", "").strip() or None
+
+def encode_cursor(id):
+    """ Turn a post id into an opaque pagination cursor """
+    return base64.urlsafe_b64encode(str(id))
+
+def decode_cursor(cursor):
+    """ Turn a pagination cursor back into a post id """
+    try:
+        return int(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        raise ValueError("Invalid cursor {}".format(cursor))
+
+def stream_posts(posts, mimetype, fields):
+    """
+    Generator which serializes posts a batch at a time, either as a single JSON
+    array or as newline delimited JSON
+    """
+    ndjson = mimetype == "application/x-ndjson"
+    if not ndjson:
+        yield "["
+
+    posts = iter(posts)
+    written = False
+    while True:
+        batch = list(islice(posts, current_app.config["STREAM_BATCH_SIZE"]))
+        if not batch:
+            break
+        rows = [codec.dump_post(post, fields) for post in batch]
+        if ndjson:
+            yield "".join(row + "\n" for row in rows)
+        else:
+            yield (", " if written else "") + ", ".join(rows)
+        written = True
+
+    if not ndjson:
+        yield "]"
+
+def listing_etag(mimetype):
+    """
+    ETag for a listing of posts. It comes from an aggregate over the table
+    rather than from the rows, and changes whenever a post is added, edited
+    or deleted.
+    """
+    count, updated_at = repository.stamp()
+    validator = "{} {} {} {}".format(request.query_string, mimetype,
+                                     count, updated_at)
+    return hashlib.sha1(validator).hexdigest()
+
+def post_etag(post, fields=codec.POST_FIELDS):
+    """ ETag for one version of a post, with only the given fields """
+    if fields == codec.POST_FIELDS:
+        return "{}-{}".format(post.id, post.version)
+    return "{}-{}-{}".format(post.id, post.version, "+".join(fields))
+
+def not_modified(etag, last_modified=None):
+    """
+    Check whether the copy the client already has, according to its
+    If-None-Match or If-Modified-Since header, is still current
+    """
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if last_modified and request.if_modified_since:
+        return last_modified.replace(microsecond=0) <= request.if_modified_since
+    return False
+
+def validated(response, etag, last_modified=None):
+    """ Add the ETag and Last-Modified headers to a response """
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    return response
+
+@blueprint.route("/api/posts", methods=["GET"])
+@decorators.accept("application/json", "application/x-ndjson")
+@decorators.replica
 def posts_get():
     """ Get a list of posts """
     # Get the querystring arguments
     title_like = request.args.get("title_like")
     body_like = request.args.get("body_like")
+    q = search_query()
+    limit = request.args.get("limit")
+    after = request.args.get("after")
 
-    # Get and filter the posts from the database
-    posts = session.query(models.Post)
-    if title_like and body_like:
-        posts = posts.filter(models.Post.title.contains(title_like)).filter(models.Post.body.contains(body_like))        
-    elif title_like:
-        posts = posts.filter(models.Post.title.contains(title_like))        
-    elif body_like:
-        posts = posts.filter(models.Post.body.contains(body_like))
-    else:
-        posts = posts.all()
+    # Check the pagination arguments
+    # If they are invalid return a 400 with a helpful message
+    try:
+        if limit is not None:
+            if not limit.isdigit() or int(limit) < 1:
+                raise ValueError("limit must be a positive integer")
+            limit = min(int(limit), current_app.config["MAX_PAGE_SIZE"])
+        elif after is not None:
+            limit = current_app.config["MAX_PAGE_SIZE"]
+        if after is not None:
+            if q:
+                raise ValueError("Search results can't be paged with a cursor")
+            after = decode_cursor(after)
+        fields = requested_fields()
+    except ValueError as error:
+        data = codec.dumps({"message": str(error)})
+        return Response(data, 400, mimetype="application/json")
+
+    # Answer with a 304 if nothing has changed since the client last asked
+    mimetype = request.accept_mimetypes.best_match(["application/json",
+                                                    "application/x-ndjson"])
+    etag = listing_etag(mimetype)
+    if not_modified(etag):
+        return validated(Response(status=304), etag)
+
+    # Stream the posts if the client asked for it, reading them a batch at a
+    # time so memory stays bounded however many there are
+    stream = (mimetype == "application/x-ndjson" or
+              request.args.get("stream") in ("1", "true"))
+
+    # Get the posts, in id order after the cursor or best search match first.
+    # Fetch one extra to find out whether there is a next page.
+    posts = repository.list(fields, title_like, body_like, q, after,
+                            limit + 1 if limit is not None else None,
+                            stream=stream and limit is None)
+
+    headers = {"Vary": "Accept"}
+    if limit is not None and len(posts) > limit:
+        posts = posts[:limit]
+        # Search results are ranked rather than in id order, so there is no
+        # cursor to give for the next page
+        if not q:
+            args = request.args.to_dict()
+            args.update(limit=limit, after=encode_cursor(posts[-1].id))
+            url = url_for(".posts_get", _external=True, **args)
+            headers["Link"] = '<{}>; rel="next"'.format(url)
+
+    if stream:
+        response = Response(stream_with_context(stream_posts(posts, mimetype, fields)),
+                            200, headers=headers, mimetype=mimetype)
+        return validated(response, etag)
 
     # Convert the posts to JSON and return a response
-    data = json.dumps([post.as_dictionary() for post in posts])
-    return Response(data, 200, mimetype="application/json")
+    with instrumentation.phase("as_dictionary"):
+        posts = [codec.as_dictionary(post, fields) for post in posts]
+    with instrumentation.phase("dumps"):
+        data = codec.dumps(posts)
+    response = Response(data, 200, headers=headers, mimetype="application/json")
+    return validated(response, etag)
 
-@app.route("/api/posts/<int:id>", methods=["GET"])
+@blueprint.route("/api/posts/_count", methods=["GET"])
 @decorators.accept("application/json")
+@decorators.replica
+def posts_count():
+    """ Count the posts, optionally filtered the same way as posts_get """
+    title_like = request.args.get("title_like")
+    body_like = request.args.get("body_like")
+    q = search_query()
+    approximate = request.args.get("approximate") in ("1", "true")
+
+    count, estimated = repository.count(title_like, body_like, q, approximate)
+    data = codec.dumps({"count": count, "approximate": estimated})
+    headers = {
+        "Cache-Control": "max-age={}".format(current_app.config["COUNT_MAX_AGE"])
+    }
+    response = Response(data, 200, headers=headers, mimetype="application/json")
+    etag = hashlib.sha1("{} {}".format(request.query_string, count)).hexdigest()
+    if not_modified(etag):
+        response = Response(status=304, headers=headers)
+    return validated(response, etag)
+
+def follow_changes(since, limit, deadline):
+    """
+    Generator which sends changes as Server-Sent Events until the deadline,
+    after which the client reconnects with the Last-Event-ID it last saw
+    """
+    while True:
+        for change in repository.changes(since, limit):
+            since = change["seq"]
+            yield "id: {}\nevent: {}\ndata: {}\n\n".format(
+                since, change["op"], codec.dumps(change))
+        if time.time() >= deadline:
+            break
+        time.sleep(current_app.config["CHANGES_POLL_INTERVAL"])
+
+@blueprint.route("/api/posts/_changes", methods=["GET"])
+@decorators.accept("application/json", "text/event-stream")
+@decorators.replica
+def posts_changes():
+    """
+    Get the changes made to posts after the since sequence number, waiting up
+    to wait seconds for some to arrive if there are none yet
+    """
+    if not repository.has_changes():
+        message = "The change feed isn't available when posts are sharded"
+        data = codec.dumps({"message": message})
+        return Response(data, 501, mimetype="application/json")
+
+    mimetype = request.accept_mimetypes.best_match(["application/json",
+                                                    "text/event-stream"])
+    since = request.headers.get("Last-Event-ID", request.args.get("since", "0"))
+    wait = request.args.get("wait")
+
+    # Check the arguments
+    # If they are invalid return a 400 with a helpful message
+    try:
+        if not since.isdigit():
+            raise ValueError("since must be a sequence number")
+        since = int(since)
+        if wait is not None:
+            wait = float(wait)
+            if wait < 0:
+                raise ValueError("wait must not be negative")
+    except ValueError as error:
+        data = codec.dumps({"message": str(error)})
+        return Response(data, 400, mimetype="application/json")
+
+    # Event streams stay open as long as they can, long polls only as long
+    # as they were asked to
+    if wait is None:
+        wait = 0 if mimetype == "application/json" else current_app.config["CHANGES_MAX_WAIT"]
+    limit = current_app.config["MAX_PAGE_SIZE"]
+    deadline = time.time() + min(wait, current_app.config["CHANGES_MAX_WAIT"])
+    headers = {"Vary": "Accept", "Cache-Control": "no-cache"}
+
+    if mimetype == "text/event-stream":
+        return Response(stream_with_context(follow_changes(since, limit, deadline)),
+                        200, headers=headers, mimetype=mimetype)
+
+    # Long poll until there are changes or the wait is over
+    changes = repository.changes(since, limit)
+    while not changes and time.time() < deadline:
+        time.sleep(current_app.config["CHANGES_POLL_INTERVAL"])
+        changes = repository.changes(since, limit)
+
+    if changes:
+        since = changes[-1]["seq"]
+    data = codec.dumps({"changes": changes, "since": since})
+    return Response(data, 200, headers=headers, mimetype="application/json")
+
+@blueprint.route("/api/posts/<int:id>", methods=["GET"])
+@decorators.accept("application/json")
+@decorators.replica
+@decorators.shard
 def post_get(id):
     """ Single post endpoint """
-    # Get the post from the database
-    post = session.query(models.Post).get(id)
+    try:
+        fields = requested_fields()
+    except ValueError as error:
+        data = codec.dumps({"message": str(error)})
+        return Response(data, 400, mimetype="application/json")
 
-    # Check whether the post exists
-    # If not return a 404 with a helpful message
-    if not post:
-        message = "Could not find post with id {}".format(id)
-        data = json.dumps({"message": message})
-        return Response(data, 404, mimetype="application/json")
+    # Serve the whole post straight from the cache if we can, otherwise get
+    # the fields we need from storage. Only reads from the primary fill the
+    # cache, so that a lagging replica can't put back a copy which a write
+    # has just invalidated.
+    cacheable = fields == codec.POST_FIELDS
+    fill_cache = cacheable and g.get("replica") is None
+    entry = None
+    if cacheable:
+        entry = cache.get(post_key(id))
+    if entry is not None:
+        data, etag, last_modified = entry
+    else:
+        post = repository.get(id, fields)
 
-    # Return the post as JSON
-    data = json.dumps(post.as_dictionary())
-    return Response(data, 200, mimetype="application/json")
+        # Check whether the post exists
+        # If not return a 404 with a helpful message
+        if not post:
+            message = "Could not find post with id {}".format(id)
+            data = codec.dumps({"message": message})
+            return Response(data, 404, mimetype="application/json")
 
-@app.route("/api/posts/<int:id>", methods=["DELETE"])
+        data = None
+        etag, last_modified = post_etag(post, fields), post.updated_at
+
+    # Answer with a 304 if the client already has this version of the post
+    if not_modified(etag, last_modified):
+        return validated(Response(status=304), etag, last_modified)
+
+    # Return the post as JSON, keeping a copy of the whole post for next time
+    if data is None:
+        with instrumentation.phase("as_dictionary"):
+            post = codec.as_dictionary(post, fields)
+        with instrumentation.phase("dumps"):
+            data = codec.dumps(post)
+        if fill_cache:
+            cache.set(post_key(id), (data, etag, last_modified))
+    response = validated(Response(data, 200, mimetype="application/json"),
+                         etag, last_modified)
+
+    # Keep the compressed copy of a whole post too, so that it is only
+    # compressed once per version
+    encoding = compression.negotiate()
+    if (encoding and cacheable and
+            len(data) >= current_app.config["COMPRESSION_MIN_SIZE"]):
+        key = post_key(id, encoding)
+        compressed = cache.get(key)
+        if compressed is None or compressed[0] != etag:
+            compressed = (etag, compression.compress(data, encoding))
+            if fill_cache:
+                cache.set(key, compressed)
+        compression.encoded(response, compressed[1], encoding)
+    return response
+
+@blueprint.route("/api/posts/<int:id>", methods=["DELETE"])
 @decorators.accept("application/json")
+@decorators.writable
+@decorators.shard
 def post_delete(id):
     """ Single post endpoint deletion """
     # Delete a post from the database
-    post = session.query(models.Post).get(id)
+    post = repository.post(id)
 
     # Check if the post exists first
     if not post:
         message = "Could not find post with id {}".format(id)
-        data = json.dumps({"message": message})
+        data = codec.dumps({"message": message})
         return Response(data, 404, mimetype="application/json")
 
-    # Delete the post
-    session.delete(post)
-    session.commit()
+    # Delete the post, unless another request changed it since it was read
+    try:
+        repository.delete(post)
+    except Conflict:
+        return conflict(id)
+    invalidate_post(id)
     message = "Deleted post with id {}".format(id)
-    data = json.dumps({"message": message})
+    data = codec.dumps({"message": message})
     return Response(data, 204, mimetype="application/json")
 
-@app.route("/api/posts", methods=["POST"])
+def conflict(id):
+    """ A 409 Conflict for a write which lost a race with another """
+    message = "Post with id {} was changed by another request, try again".format(id)
+    data = codec.dumps({"message": message})
+    return Response(data, 409, mimetype="application/json")
+
+def queue_write(op, id, data):
+    """
+    Queue a write for the background writer and return a 202 Accepted, or a
+    503 if the queue is full
+    """
+    try:
+        ticket = writes.submit(op, id, {"title": data["title"],
+                                        "body": data["body"]})
+    except QueueFull:
+        message = "Too many writes are waiting, try again shortly"
+        data = codec.dumps({"message": message})
+        return Response(data, 503, headers={"Retry-After": "1"},
+                        mimetype="application/json")
+
+    data = codec.dumps({"id": id, "ticket": ticket, "status": "pending"})
+    headers = {"Location": url_for(".write_status", ticket=ticket)}
+    return Response(data, 202, headers=headers, mimetype="application/json")
+
+@blueprint.route("/api/writes/<ticket>", methods=["GET"])
+@decorators.accept("application/json")
+def write_status(ticket):
+    """ Whether a queued write is still pending, committed or failed """
+    status = writes.status(ticket)
+    if status is None:
+        message = "Could not find write {}".format(ticket)
+        data = codec.dumps({"message": message})
+        return Response(data, 404, mimetype="application/json")
+
+    data = codec.dumps(dict(status, ticket=ticket))
+    return Response(data, 200, mimetype="application/json")
+
+@blueprint.route("/api/posts", methods=["POST"])
 @decorators.accept("application/json")
 @decorators.require("application/json")
+@decorators.writable
 def posts_post():
     """ Add a new post """
     data = request.json
@@ -88,41 +412,48 @@ def posts_post():
     # Check that the JSON supplied is valid
     # If not you return a 422 Unprocessable Entity
     try:
-        validate(data, post_schema)
+        codec.post_validator.validate(data)
     except ValidationError as error:
         data = {"message": error.message}
-        return Response(json.dumps(data), 422, mimetype="application/json")
+        return Response(codec.dumps(data), 422, mimetype="application/json")
+
+    # In write-behind mode queue the post to be written in the background,
+    # returning a 202 Accepted which points at the status of the write
+    if current_app.config["WRITE_BEHIND"]:
+        return queue_write("create", writes.allocate_id(session), data)
 
     # Add the post to the database
-    post = models.Post(title=data["title"], body=data["body"])
-    session.add(post)
-    session.commit()
+    post = repository.create(data["title"], data["body"])
+    invalidate_post(post.id)
 
     # Return a 201 Created, containing the post as JSON and with the
     # Location header set to the location of the post
-    data = json.dumps(post.as_dictionary())
-    headers = {"Location": url_for("post_get", id=post.id)}
-    return Response(data, 201, headers=headers,
-                    mimetype="application/json")
+    data = codec.dumps(post.as_dictionary())
+    headers = {"Location": url_for(".post_get", id=post.id)}
+    response = Response(data, 201, headers=headers,
+                        mimetype="application/json")
+    return validated(response, post_etag(post), post.updated_at)
 
-@app.route("/api/post/<int:id>", methods=["PUT"])
+@blueprint.route("/api/post/<int:id>", methods=["PUT"])
 @decorators.accept("application/json")
 @decorators.require("application/json")
+@decorators.writable
+@decorators.shard
 def posts_edit(id):
     """ Edit post """
     
     # Get a post by id
-    post = session.query(models.Post).get(id)
+    post = repository.post(id)
     
     # Check whether the post exists
     # If not return a 404 with a helpful message
     if not post:
         message = "Could not find post with id {}".format(id)
-        data = json.dumps({"message": message})
+        data = codec.dumps({"message": message})
         return Response(data, 404, mimetype="application/json")
 
     # Return the post as JSON
-    #data = json.dumps(post.as_dictionary())
+    #data = codec.dumps(post.as_dictionary())
     #return Response(data, 200, mimetype="application/json")
 
     data = request.json
@@ -130,19 +461,119 @@ def posts_edit(id):
     # Check that the JSON supplied is valid
     # If not you return a 422 Unprocessable Entity
     try:
-        validate(data, post_schema)
+        codec.post_validator.validate(data)
     except ValidationError as error:
         data = {"message": error.message}
-        return Response(json.dumps(data), 422, mimetype="application/json")
+        return Response(codec.dumps(data), 422, mimetype="application/json")
 
-    # Update the post in the database
-    post.title=data["title"]
-    post.body=data["body"]
-    session.commit()
+    if current_app.config["WRITE_BEHIND"]:
+        return queue_write("update", id, data)
+
+    # Update the post in the database, unless another request changed it
+    # since it was read
+    try:
+        repository.update(post, data["title"], data["body"])
+    except Conflict:
+        return conflict(id)
+    invalidate_post(id)
 
     # Return a 201(?) Created, containing the post as JSON and with the
     # Location header set to the location of the post
-    data = json.dumps(post.as_dictionary())
-    headers = {"Location": url_for("post_get", id=post.id)}
-    return Response(data, 201, headers=headers,
-                    mimetype="application/json")
\ No newline at end of file
+    data = codec.dumps(post.as_dictionary())
+    headers = {"Location": url_for(".post_get", id=post.id)}
+    response = Response(data, 201, headers=headers,
+                        mimetype="application/json")
+    return validated(response, post_etag(post), post.updated_at)
+
+@blueprint.route("/metrics", methods=["GET"])
+def metrics():
+    """ Request, phase and SQL timings and cache counters, for Prometheus """
+    lines = [instrumentation.registry.render()]
+    for name, value in sorted(cache.stats().items()):
+        kind = "gauge" if name == "size" else "counter"
+        name = "posts_cache_{}".format(name if kind == "gauge" else name + "_total")
+        lines.append("# TYPE {} {}\n{} {}\n".format(name, kind, name, value))
+    return Response("".join(lines), 200,
+                    mimetype="text/plain; version=0.0.4")
+
+@blueprint.route("/api/cache", methods=["GET"])
+@decorators.accept("application/json")
+def cache_stats():
+    """ Hit, miss and eviction counts for the post cache """
+    data = codec.dumps(cache.stats())
+    return Response(data, 200, mimetype="application/json")
+
+def check_operation(operation):
+    """
+    Check that a bulk operation is valid, returning it as an (op, id, data)
+    tuple. Raises a ValueError with a helpful message if it isn't.
+    """
+    if not isinstance(operation, dict):
+        raise ValueError("Operation must be an object")
+
+    op = operation.get("op")
+    if op not in ("create", "update", "delete"):
+        raise ValueError("op must be one of create, update or delete")
+
+    # New posts are always given their id by the server
+    id = operation.get("id") if op != "create" else None
+    if op != "create" and (not isinstance(id, int) or isinstance(id, bool)):
+        raise ValueError("id must be an integer")
+
+    if op != "delete":
+        error = next(codec.post_validator.iter_errors(operation), None)
+        if error:
+            raise ValueError(error.message)
+
+    return op, id, operation
+
+@blueprint.route("/api/posts/_bulk", methods=["POST"])
+@decorators.accept("application/json")
+@decorators.require("application/json", "application/x-ndjson")
+@decorators.writable
+def posts_bulk():
+    """ Create, update and delete many posts at once """
+    # Read the operations, either from a JSON array or from one JSON object
+    # per line. Lines are decoded as they are read so a large upload is never
+    # held in memory all at once.
+    if request.mimetype == "application/x-ndjson":
+        operations = (line for line in request.stream if line.strip())
+        decode = codec.loads
+    else:
+        operations = request.json
+        decode = lambda operation: operation
+        if not isinstance(operations, list):
+            message = "Request must contain an array of operations"
+            data = codec.dumps({"message": message})
+            return Response(data, 422, mimetype="application/json")
+
+    # Check and apply the operations a chunk at a time, with one transaction
+    # per chunk
+    items = []
+    operations = iter(operations)
+    while True:
+        chunk = list(islice(operations, current_app.config["BULK_CHUNK_SIZE"]))
+        if not chunk:
+            break
+
+        valid, positions = [], []
+        for operation in chunk:
+            try:
+                valid.append(check_operation(decode(operation)))
+            except ValueError as error:
+                items.append({"status": 422, "message": str(error)})
+            else:
+                positions.append(len(items))
+                items.append(None)
+
+        results = repository.bulk(valid)
+        for position, result in zip(positions, results):
+            items[position] = result
+            if "id" in result:
+                invalidate_post(result["id"])
+
+    data = codec.dumps({
+        "errors": any(item["status"] >= 400 for item in items),
+        "items": items
+    })
+    return Response(data, 200, mimetype="application/json")
@@ -0,0 +1,136 @@
+from sqlalchemy import select, bindparam
+from sqlalchemy.exc import SQLAlchemyError
+
+import models
+import sharding
+from database import Session, get_database
+
+posts = models.Post.__table__
+
+def allocate_ids(session, count):
+    """
+    Reserve ids for count new posts from the posts sequence, so they can be
+    inserted with a single executemany. Returns None if the database has no
+    sequence to take them from.
+    """
+    if session.get_bind(models.Post).dialect.name != "postgresql":
+        return None
+    result = session.execute("SELECT nextval('posts_id_seq') "
+                             "FROM generate_series(1, :count)",
+                             {"count": count})
+    return [row[0] for row in result]
+
+def apply(session, operations):
+    """
+    Apply a chunk of already validated operations in a single transaction.
+    Each operation is an (op, id, data) tuple, and a result with the HTTP
+    status for each one is returned in the same order. Creates come with
+    the id the new post should have when apply_to_shards has assigned one,
+    or else None.
+    """
+    results = [None] * len(operations)
+
+    # Find out which of the posts being updated or deleted exist
+    ids = [id for op, id, data in operations if op != "create"]
+    existing = set()
+    if ids:
+        query = select([posts.c.id]).where(posts.c.id.in_(ids))
+        existing = set(row[0] for row in session.execute(query))
+
+    creates, updates, deletes = [], [], []
+    for index, (op, id, data) in enumerate(operations):
+        if op == "create":
+            creates.append((index, id, data))
+        elif id not in existing:
+            message = "Could not find post with id {}".format(id)
+            results[index] = {"status": 404, "message": message}
+        elif op == "update":
+            updates.append((index, id, data))
+        else:
+            existing.discard(id)
+            deletes.append((index, id))
+
+    try:
+        if creates:
+            rows = [{"title": data["title"], "body": data["body"], "version": 1}
+                    for index, id, data in creates]
+            ids = [id for index, id, data in creates]
+            if None in ids:
+                ids = allocate_ids(session, len(rows))
+            if ids:
+                for row, id in zip(rows, ids):
+                    row["id"] = id
+                session.execute(posts.insert(), rows)
+            else:
+                # Without a sequence the only way to learn each new id is
+                # to insert the rows one at a time
+                ids = [session.execute(posts.insert(), row).inserted_primary_key[0]
+                       for row in rows]
+            for (index, _, data), id in zip(creates, ids):
+                results[index] = {"status": 201, "id": id}
+            models.adjust_post_count(session, len(creates))
+            models.record_changes(session, "create", ids)
+
+        if updates:
+            statement = posts.update().where(posts.c.id == bindparam("_id"))
+            statement = statement.values(version=posts.c.version + 1)
+            session.execute(statement, [
+                {"_id": id, "title": data["title"], "body": data["body"]}
+                for index, id, data in updates
+            ])
+            for index, id, data in updates:
+                results[index] = {"status": 200, "id": id}
+            models.record_changes(session, "update",
+                                  [id for index, id, data in updates])
+
+        if deletes:
+            ids = [id for index, id in deletes]
+            session.execute(posts.delete().where(posts.c.id.in_(ids)))
+            for index, id in deletes:
+                results[index] = {"status": 204, "id": id}
+            models.adjust_post_count(session, -len(deletes))
+            models.record_changes(session, "delete", ids)
+
+        session.commit()
+    except SQLAlchemyError:
+        session.rollback()
+        for index, result in enumerate(results):
+            if result is None or result["status"] < 400:
+                results[index] = {"status": 500,
+                                  "message": "Could not save the changes"}
+
+    return results
+
+def apply_to_shards(session, operations):
+    """
+    Apply a chunk of operations, each on the shard its post lives on, with
+    one transaction per shard. New posts are given their ids first so that
+    their shard is known.
+    """
+    database = get_database()
+    if len(database.shards) == 1:
+        return apply(session, operations)
+
+    operations = list(operations)
+    creates = [index for index, (op, id, data) in enumerate(operations)
+               if op == "create"]
+    for index, id in zip(creates, sharding.allocate_ids(len(creates))):
+        op, _, data = operations[index]
+        operations[index] = (op, id, data)
+
+    groups = {}
+    for index, operation in enumerate(operations):
+        shard = database.shard_for(operation[1])
+        groups.setdefault(shard, []).append((index, operation))
+
+    results = [None] * len(operations)
+    for shard, group in groups.items():
+        shard_session = Session(bind=shard)
+        try:
+            shard_results = apply(shard_session,
+                                  [operation for index, operation in group])
+        finally:
+            shard_session.close()
+        for (index, operation), result in zip(group, shard_results):
+            results[index] = result
+    return results
@@ -0,0 +1,167 @@
+import time
+import pickle
+import threading
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+from flask import current_app
+from werkzeug.local import LocalProxy
+
+from compression import COMPRESSORS
+
+class NullCache(object):
+    """ Cache which never stores anything, used when caching is turned off """
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+    def stats(self):
+        return {}
+
+class LRUCache(object):
+    """
+    In-process cache which keeps the most recently used entries, up to
+    max_size of them, each for at most ttl seconds
+    """
+    def __init__(self, max_size=1024, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            try:
+                value, expires = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+
+            if expires is not None and expires < time.time():
+                self.misses += 1
+                self.evictions += 1
+                return None
+
+            # Re-insert the entry to mark it as the most recently used
+            self.entries[key] = (value, expires)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        expires = time.time() + self.ttl if self.ttl else None
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, expires)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": len(self.entries)
+        }
+
+class RedisCache(object):
+    """
+    Cache shared between processes through Redis, or anything which speaks
+    its protocol. Redis does its own eviction once it reaches maxmemory.
+    """
+    def __init__(self, url, ttl=None, prefix="posts:"):
+        if redis is None:
+            raise RuntimeError("The redis cache backend needs the redis package")
+        self.client = redis.StrictRedis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return pickle.loads(value)
+
+    def set(self, key, value):
+        value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        self.client.set(self.prefix + key, value, ex=self.ttl)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + "*"):
+            self.client.delete(key)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.client.info("stats").get("evicted_keys", 0)
+        }
+
+def make_cache(config):
+    """ Create the cache backend named by the CACHE_BACKEND setting """
+    backend = config["CACHE_BACKEND"]
+    if backend == "memory":
+        return LRUCache(config["CACHE_MAX_SIZE"], config["CACHE_TTL"])
+    if backend == "redis":
+        return RedisCache(config["CACHE_REDIS_URL"], config["CACHE_TTL"])
+    return NullCache()
+
+def init_app(app):
+    """ Give an app the cache backend its config asks for """
+    app.extensions["cache"] = make_cache(app.config)
+
+def share_between_workers(app):
+    """
+    Prepare an app's cache for serving from several worker processes. Only
+    the worker which changes a post drops its copy from a memory cache, so
+    the others keep their copies for at most CACHE_MEMORY_TTL seconds.
+    """
+    if app.config["CACHE_BACKEND"] == "memory":
+        ttl, memory_ttl = app.config["CACHE_TTL"], app.config["CACHE_MEMORY_TTL"]
+        # No TTL means entries never expire, which is longer than any
+        app.config["CACHE_TTL"] = min(ttl, memory_ttl) if ttl else memory_ttl
+        init_app(app)
+
+# The cache of the current app
+cache = LocalProxy(lambda: current_app.extensions["cache"])
+
+def post_key(id, encoding=None):
+    """ Cache key for a post, or for a compressed copy of it """
+    if encoding:
+        return "post:{}:{}".format(id, encoding)
+    return "post:{}".format(id)
+
+def invalidate_post(id):
+    """ Drop every cached copy of a post, compressed or not """
+    for encoding in [None] + sorted(COMPRESSORS):
+        cache.delete(post_key(id, encoding))
@@ -0,0 +1,55 @@
+import json
+
+from jsonschema import Draft4Validator
+
+# Use the fastest JSON library available, falling back to the standard one
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+# JSON Schema describing the structure of a post
+post_schema = {
+    "properties": {
+        "title" : {"type" : "string"},
+        "body": {"type": "string"}
+    },
+    "required": ["title", "body"]
+}
+# Check the schema and build its validator once, rather than on every
+# request as jsonschema.validate does
+Draft4Validator.check_schema(post_schema)
+post_validator = Draft4Validator(post_schema)
+
+# The fields of a post, in the order they are selected from the database
+POST_FIELDS = ("id", "title", "body")
+
+if orjson is not None:
+    def dumps(data):
+        return orjson.dumps(data).decode("utf-8")
+    loads = orjson.loads
+elif ujson is not None:
+    dumps = ujson.dumps
+    loads = ujson.loads
+else:
+    dumps = json.dumps
+    loads = json.loads
+
+def as_dictionary(row, fields=POST_FIELDS):
+    """
+    Turn a row of post columns into a dictionary, without going through a
+    Post object
+    """
+    return dict(zip(fields, row))
+
+def dump_post(row, fields=POST_FIELDS):
+    """ Serialize a row of post columns to JSON """
+    return dumps(as_dictionary(row, fields))
+
+def dump_posts(rows, fields=POST_FIELDS):
+    """ Serialize rows of post columns to a JSON array """
+    return dumps([as_dictionary(row, fields) for row in rows])
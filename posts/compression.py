@@ -0,0 +1,145 @@
+import zlib
+
+from flask import request, current_app
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Content encodings we can produce, in order of preference when the client
+# is equally happy with several
+ENCODINGS = [encoding for encoding, module in [("br", brotli),
+                                                ("zstd", zstandard),
+                                                ("gzip", zlib)]
+             if module is not None]
+
+# Mimetypes which are worth compressing
+COMPRESSIBLE = ("application/json", "application/x-ndjson")
+
+class GzipCompressor(object):
+    def __init__(self):
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def flush(self):
+        return self.compressor.flush()
+
+class BrotliCompressor(object):
+    def __init__(self):
+        # Quality 4 compresses nearly as well as gzip -9 at gzip -6 speeds
+        self.compressor = brotli.Compressor(quality=4)
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def flush(self):
+        return self.compressor.finish()
+
+class ZstdCompressor(object):
+    def __init__(self):
+        self.compressor = zstandard.ZstdCompressor(level=3).compressobj()
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def flush(self):
+        return self.compressor.flush()
+
+COMPRESSORS = {
+    "gzip": GzipCompressor,
+    "br": BrotliCompressor,
+    "zstd": ZstdCompressor
+}
+
+def refused(accept, encoding):
+    """
+    Whether an Accept-Encoding header rules an encoding out with q=0, by
+    name or through * when it isn't named
+    """
+    qualities = dict(accept)
+    if encoding in qualities:
+        return qualities[encoding] == 0
+    return qualities.get("*") == 0
+
+def negotiate():
+    """ The content encoding to use for the current request, if any """
+    if not current_app.config["COMPRESSION"]:
+        return None
+    # best_match would still choose an encoding the client refused
+    accept = request.accept_encodings
+    encodings = [encoding for encoding in ENCODINGS
+                 if not refused(accept, encoding)]
+    return accept.best_match(encodings)
+
+def compress(data, encoding):
+    """ Compress a whole response body """
+    compressor = COMPRESSORS[encoding]()
+    return compressor.compress(data) + compressor.flush()
+
+def compress_stream(chunks, encoding):
+    """ Generator which compresses a streamed response body as it goes """
+    compressor = COMPRESSORS[encoding]()
+    try:
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+def weaken_etag(response):
+    """
+    Make a compressed response's ETag weak. A strong ETag has to be byte for
+    byte exact, which the compressed body no longer is.
+    """
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(etag, weak=True)
+
+def encoded(response, data, encoding):
+    """ Give a response an already compressed body """
+    response.set_data(data)
+    response.headers["Content-Encoding"] = encoding
+    weaken_etag(response)
+    return response
+
+def compress_response(response):
+    """
+    Compress JSON responses which the client can decode and which are large
+    enough to be worth it. Streamed responses are compressed as they stream.
+    """
+    if (not current_app.config["COMPRESSION"] or
+            response.mimetype not in COMPRESSIBLE and response.status_code != 304):
+        return response
+    response.vary.add("Accept-Encoding")
+
+    encoding = negotiate()
+    if encoding is None or "Content-Encoding" in response.headers:
+        return response
+
+    if response.status_code == 304:
+        # Match the weak ETag a compressed 200 would have had
+        weaken_etag(response)
+    elif response.is_streamed:
+        response.response = compress_stream(response.response, encoding)
+        response.headers["Content-Encoding"] = encoding
+        response.headers.pop("Content-Length", None)
+        weaken_etag(response)
+    elif response.status_code < 300:
+        data = response.get_data()
+        if len(data) >= current_app.config["COMPRESSION_MIN_SIZE"]:
+            encoded(response, compress(data, encoding), encoding)
+    return response
+
+def init_app(app):
+    """ Compress an app's responses """
+    app.after_request(compress_response)
@@ -1,10 +1,239 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+import time
+import zlib
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import g, request, current_app, has_app_context
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import sessionmaker, scoped_session, Session as BaseSession
+from sqlalchemy.sql.expression import UpdateBase
 from sqlalchemy.ext.declarative import declarative_base
+from werkzeug.local import LocalProxy
+
+def engine_options(config, uri):
+    """ Keyword arguments for create_engine, taken from the config """
+    options = {"pool_recycle": config["DATABASE_POOL_RECYCLE"]}
+    # SQLite doesn't use a connection pool which can be sized
+    if make_url(uri).drivername != "sqlite":
+        options.update(pool_size=config["DATABASE_POOL_SIZE"],
+                       max_overflow=config["DATABASE_MAX_OVERFLOW"],
+                       pool_timeout=config["DATABASE_POOL_TIMEOUT"])
+    return options
+
+def ping_connection(dbapi_connection, connection_record, connection_proxy):
+    """
+    Check that a pooled connection still works before handing it out, so
+    that connections the server has dropped are replaced rather than failing
+    the request
+    """
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute("SELECT 1")
+    except Exception:
+        raise exc.DisconnectionError()
+    finally:
+        cursor.close()
+
+def make_engine(config, uri):
+    """ Create an engine for one database, pooled as the config says """
+    engine = create_engine(uri, **engine_options(config, uri))
+    if config["DATABASE_POOL_PRE_PING"]:
+        event.listen(engine.pool, "checkout", ping_connection)
+    return engine
+
+class ReplicaSet(object):
+    """
+    Read replicas, handed out round robin. Each replica is health checked at
+    most once every check_interval seconds, and skipped while it is down.
+    """
+    def __init__(self, engines, check_interval):
+        self.engines = engines
+        self.check_interval = check_interval
+        self.healthy = dict((engine, True) for engine in engines)
+        self.checked = dict((engine, 0) for engine in engines)
+        self.position = 0
+        self.lock = threading.Lock()
+
+    def is_healthy(self, engine):
+        now = time.time()
+        if now - self.checked[engine] >= self.check_interval:
+            self.checked[engine] = now
+            try:
+                connection = engine.connect()
+                try:
+                    connection.execute("SELECT 1")
+                finally:
+                    connection.close()
+                self.healthy[engine] = True
+            except exc.SQLAlchemyError:
+                self.healthy[engine] = False
+        return self.healthy[engine]
+
+    def choose(self):
+        """ The next healthy replica, or None if there isn't one """
+        for i in range(len(self.engines)):
+            with self.lock:
+                engine = self.engines[self.position]
+                self.position = (self.position + 1) % len(self.engines)
+            if self.is_healthy(engine):
+                return engine
+        return None
+
+class Database(object):
+    """
+    The engines an app talks to. They are created the first time they are
+    used rather than when the app is, so that building an app does no I/O.
+    """
+    def __init__(self, config):
+        self.config = config
+        self._engine = None
+        self._replicas = None
+        self._shards = None
+        self._executor = None
+        self.lock = threading.Lock()
+
+    @property
+    def engine(self):
+        """ The engine for the primary database """
+        with self.lock:
+            if self._engine is None:
+                self._engine = make_engine(self.config, self.config["DATABASE_URI"])
+            return self._engine
+
+    @property
+    def replicas(self):
+        """ The ReplicaSet of read replicas, which may be empty """
+        with self.lock:
+            if self._replicas is None:
+                self._replicas = ReplicaSet(
+                    [make_engine(self.config, uri)
+                     for uri in self.config["DATABASE_REPLICA_URIS"]],
+                    self.config["REPLICA_HEALTH_CHECK_INTERVAL"])
+            return self._replicas
 
-from posts import app
+    @property
+    def shards(self):
+        """
+        The engine for each database posts are spread across, the primary
+        first. Without any DATABASE_SHARD_URIS the primary is the only one.
+        """
+        primary = self.engine
+        with self.lock:
+            if self._shards is None:
+                self._shards = [primary] + [
+                    make_engine(self.config, uri)
+                    for uri in self.config["DATABASE_SHARD_URIS"]]
+            return self._shards
+
+    @property
+    def executor(self):
+        """ Threads which query every shard at once, for every request """
+        shards = self.shards
+        with self.lock:
+            if self._executor is None:
+                workers = self.config["SHARD_FAN_OUT_WORKERS"]
+                if workers is None:
+                    workers = len(shards) * (self.config["DATABASE_POOL_SIZE"] +
+                                             self.config["DATABASE_MAX_OVERFLOW"])
+                self._executor = ThreadPoolExecutor(max_workers=workers)
+            return self._executor
+
+    def shard_for(self, id):
+        """ The engine for the shard which the post with the given id lives on """
+        shards = self.shards
+        if self.config["SHARD_BY"] == "range":
+            index = id // self.config["SHARD_RANGE_SIZE"] % len(shards)
+        else:
+            # Hash the id rather than taking it modulo the number of shards,
+            # so that ids which share a pattern, like all being even, still
+            # spread evenly
+            index = zlib.crc32(str(id)) % len(shards)
+        return shards[index]
+
+    def dispose(self):
+        """
+        Close every pooled connection, to the primary, the replicas and the
+        shards. The executor's threads don't survive a fork, so it is thrown
+        away too.
+        """
+        if self._engine is not None:
+            self._engine.dispose()
+        if self._replicas is not None:
+            for replica in self._replicas.engines:
+                replica.dispose()
+        if self._shards is not None:
+            for shard in self._shards[1:]:
+                shard.dispose()
+        self._executor = None
+
+def get_database(app=None):
+    """ The Database of an app, by default the current one """
+    return (app or current_app).extensions["database"]
+
+# The engines of the current app
+engine = LocalProxy(lambda: get_database().engine)
+replicas = LocalProxy(lambda: get_database().replicas)
+
+class RoutingSession(BaseSession):
+    """
+    Session which sends the reads of a request to the replica chosen for it,
+    and everything else to the primary. Requests about one post use the
+    shard chosen for them instead. Sessions made without a bind use the
+    engines of the current app.
+    """
+    def get_bind(self, mapper=None, clause=None):
+        if self.bind is not None:
+            return self.bind
+        if has_app_context() and g.get("shard") is not None:
+            # Requests about one post go to the shard it lives on
+            return g.shard
+        if self._flushing or isinstance(clause, UpdateBase):
+            return get_database().engine
+        if has_app_context() and g.get("replica") is not None:
+            return g.replica
+        return get_database().engine
+
+def wrote_recently():
+    """ Whether the client made a write within the read-your-writes window """
+    try:
+        last_write = float(request.cookies.get("last_write", 0))
+    except ValueError:
+        return False
+    return time.time() - last_write < current_app.config["READ_YOUR_WRITES_WINDOW"]
+
+def remember_write(response):
+    """
+    Note the time of a successful write in a cookie, so the client's reads
+    stay on the primary until the replicas have caught up
+    """
+    if (replicas.engines and request.method in ("POST", "PUT", "DELETE") and
+            response.status_code < 400):
+        response.set_cookie("last_write", str(time.time()),
+                            max_age=current_app.config["READ_YOUR_WRITES_WINDOW"])
+    return response
 
-engine = create_engine(app.config["DATABASE_URI"])
 Base = declarative_base()
-Session = sessionmaker(bind=engine)
-session = Session()
+Session = sessionmaker(class_=RoutingSession)
+# Each thread gets its own session, which is thrown away at the end of the
+# request so the identity map doesn't keep growing
+session = scoped_session(Session)
+
+def remove_session(exception=None):
+    session.remove()
+
+def forget_routing(exception=None):
+    """ Forget the replica or shard a request's queries were sent to """
+    g.replica = None
+    g.shard = None
+
+def init_app(app):
+    """ Give an app its Database, and the hooks which go with it """
+    app.extensions["database"] = Database(app.config)
+    app.after_request(remember_write)
+    # Requests made inside an app context which is already pushed don't
+    # tear it down, so remove the session at the end of each request too
+    app.teardown_request(remove_session)
+    app.teardown_request(forget_routing)
+    app.teardown_appcontext(remove_session)
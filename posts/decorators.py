@@ -1,36 +1,84 @@
-import json
 from functools import wraps
 
-from flask import request, Response
+from flask import request, Response, g
 
-def accept(mimetype):
+import codec
+import sharding
+import instrumentation
+from database import replicas, wrote_recently
+from repository import repository
+
+def accept(*mimetypes):
     def decorator(func):
         """
         Decorator which returns a 406 Not Acceptable if the client won't accept
-        a certain mimetype
+        any of the given mimetypes
         """
         @wraps(func)
         def wrapper(*args, **kwargs):
-            if mimetype in request.accept_mimetypes:
+            with instrumentation.phase("accept"):
+                acceptable = any(mimetype in request.accept_mimetypes
+                                 for mimetype in mimetypes)
+            if acceptable:
                 return func(*args, **kwargs)
-            message = "Request must accept {} data".format(mimetype)
-            data = json.dumps({"message": message})
+            message = "Request must accept {} data".format(mimetypes[0])
+            data = codec.dumps({"message": message})
             return Response(data, 406, mimetype="application/json")
         return wrapper
     return decorator
 
-def require(mimetype):
+def require(*mimetypes):
     def decorator(func):
         """
         Decorator which returns a 415 Unsupported Media Type if the client sends
-        something other than a certain mimetype
+        something other than one of the given mimetypes
         """
         @wraps(func)
         def wrapper(*args, **kwargs):
-            if (request.mimetype ==  mimetype):
+            with instrumentation.phase("require"):
+                supported = request.mimetype in mimetypes
+            if supported:
                 return func(*args, **kwargs)
-            message = "Request must contain {} data".format(mimetype)
-            data = json.dumps({"message": message})
+            message = "Request must contain {} data".format(mimetypes[0])
+            data = codec.dumps({"message": message})
             return Response(data, 415, mimetype="application/json")
         return wrapper
-    return decorator
\ No newline at end of file
+    return decorator
+
+def replica(func):
+    """
+    Decorator which sends the queries a route makes to a read replica, unless
+    the client has written recently and so should read from the primary
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if replicas.engines and not wrote_recently():
+            g.replica = replicas.choose()
+        return func(*args, **kwargs)
+    return wrapper
+
+def shard(func):
+    """
+    Decorator which sends the queries a route about one post makes to the
+    shard that post lives on
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        sharding.use_shard(kwargs["id"])
+        return func(*args, **kwargs)
+    return wrapper
+
+def writable(func):
+    """
+    Decorator which returns a 405 Method Not Allowed if posts are being
+    served from a read-only replica
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not repository.read_only:
+            return func(*args, **kwargs)
+        message = "Posts can't be changed on a read-only replica"
+        data = codec.dumps({"message": message})
+        return Response(data, 405, headers={"Allow": "GET, HEAD"},
+                        mimetype="application/json")
+    return wrapper
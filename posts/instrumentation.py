@@ -0,0 +1,190 @@
+import os
+import hmac
+import time
+import random
+import cProfile
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from flask import g, request, current_app, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0)
+
+class Histogram(object):
+    """ Counts of observed durations, bucketed the way Prometheus expects """
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Registry(object):
+    """ Histograms and counters, each keyed by a name and a set of labels """
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def clear(self):
+        with self.lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+    def render(self):
+        """ The metrics in the Prometheus text exposition format """
+        lines = []
+        with self.lock:
+            for name in sorted(set(key[0] for key in self.histograms)):
+                lines.append("# TYPE {} histogram".format(name))
+                for (key, labels), histogram in sorted(self.histograms.items()):
+                    if key != name:
+                        continue
+                    cumulative = 0
+                    bounds = [str(bound) for bound in histogram.buckets] + ["+Inf"]
+                    for bound, count in zip(bounds, histogram.counts):
+                        cumulative += count
+                        lines.append("{}_bucket{} {}".format(
+                            name, format_labels(labels + (("le", bound),)),
+                            cumulative))
+                    lines.append("{}_sum{} {}".format(
+                        name, format_labels(labels), histogram.sum))
+                    lines.append("{}_count{} {}".format(
+                        name, format_labels(labels), histogram.count))
+            for name in sorted(set(key[0] for key in self.counters)):
+                lines.append("# TYPE {} counter".format(name))
+                for (key, labels), value in sorted(self.counters.items()):
+                    if key == name:
+                        lines.append("{}{} {}".format(
+                            name, format_labels(labels), value))
+        return "\n".join(lines) + "\n"
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(key, value)
+                          for key, value in labels) + "}"
+
+registry = Registry()
+
+def enabled():
+    return has_request_context() and current_app.config["INSTRUMENTATION"]
+
+def route():
+    # Label by view name, leaving out the blueprint the view belongs to
+    if not request.endpoint:
+        return "unknown"
+    return request.endpoint.rsplit(".", 1)[-1]
+
+@contextmanager
+def phase(name):
+    """ Time a phase of handling the current request """
+    if not enabled():
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        registry.observe("posts_phase_seconds", time.time() - start,
+                         route=route(), phase=name)
+
+def fetch(query):
+    """
+    Run a query and return its rows, timing separately the SQL and the
+    hydration of the rows it returns
+    """
+    if not enabled():
+        return query.all()
+    start, sql_seconds = time.time(), g.get("sql_seconds", 0.0)
+    rows = query.all()
+    elapsed = time.time() - start
+    sql = g.get("sql_seconds", 0.0) - sql_seconds
+    registry.observe("posts_phase_seconds", elapsed, route=route(), phase="query")
+    registry.observe("posts_phase_seconds", max(elapsed - sql, 0.0),
+                     route=route(), phase="hydrate")
+    return rows
+
+@event.listens_for(Engine, "before_cursor_execute")
+def before_cursor_execute(connection, cursor, statement, parameters, context,
+                          executemany):
+    connection.info.setdefault("query_start", []).append(time.time())
+
+@event.listens_for(Engine, "after_cursor_execute")
+def after_cursor_execute(connection, cursor, statement, parameters, context,
+                         executemany):
+    elapsed = time.time() - connection.info["query_start"].pop()
+    if enabled():
+        g.sql_seconds = g.get("sql_seconds", 0.0) + elapsed
+        registry.observe("posts_sql_seconds", elapsed, route=route())
+        registry.increment("posts_sql_statements_total", route=route())
+
+def profile_requested():
+    """
+    Whether the client asked for its request to be profiled. Profiling is
+    slow and writes a file, so only clients which know the secret can.
+    """
+    secret = current_app.config["PROFILE_SECRET"]
+    header = request.headers.get("X-Profile")
+    if not secret or header is None:
+        return False
+    return hmac.compare_digest(str(header), str(secret))
+
+def start_request():
+    if not current_app.config["INSTRUMENTATION"]:
+        return
+    g.request_start = time.time()
+
+    # Profile the request if the client asked for it, or if it is one of
+    # the sampled requests
+    if (profile_requested() or
+            random.random() < current_app.config["PROFILE_SAMPLE_RATE"]):
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+def record_status(response):
+    g.status = response.status_code
+    return response
+
+def finish_request(exception=None):
+    if not current_app.config["INSTRUMENTATION"] or "request_start" not in g:
+        return
+    registry.observe("posts_request_seconds", time.time() - g.request_start,
+                     route=route(), method=request.method,
+                     status=g.get("status", 500))
+
+    profiler = g.get("profiler")
+    if profiler is not None:
+        profiler.disable()
+        if not os.path.isdir(current_app.config["PROFILE_DIR"]):
+            os.makedirs(current_app.config["PROFILE_DIR"])
+        filename = "{}-{}-{}.prof".format(route(), int(time.time() * 1000),
+                                          os.getpid())
+        profiler.dump_stats(os.path.join(current_app.config["PROFILE_DIR"], filename))
+
+def init_app(app):
+    """ Time, and when asked to profile, each of an app's requests """
+    app.before_request(start_request)
+    app.after_request(record_status)
+    app.teardown_request(finish_request)
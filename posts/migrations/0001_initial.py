@@ -0,0 +1,110 @@
+"""
+The posts, counters and post_changes tables, together with the triggers
+which keep posts searchable. Databases from before there were migrations
+already have a posts table, which is given whichever of the later columns
+it lacks. On Postgres, filling those columns in and indexing the existing
+posts for search is left to 0003, which does it without locking the table.
+"""
+from sqlalchemy import (MetaData, Table, Column, Integer, BigInteger, String,
+                        Text, DateTime, inspect)
+from sqlalchemy.dialects.postgresql import TSVECTOR
+
+metadata = MetaData()
+
+posts = Table("posts", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("title", String(128)),
+    Column("body", String(1024)),
+    Column("version", Integer, nullable=False),
+    Column("updated_at", DateTime, nullable=False),
+    Column("search_vector", Text().with_variant(TSVECTOR(), "postgresql"))
+)
+
+counters = Table("counters", metadata,
+    Column("name", String(64), primary_key=True),
+    Column("value", BigInteger, nullable=False)
+)
+
+post_changes = Table("post_changes", metadata,
+    Column("seq", Integer, primary_key=True),
+    Column("post_id", Integer, nullable=False),
+    Column("op", String(16), nullable=False),
+    Column("changed_at", DateTime, nullable=False)
+)
+
+# Postgres keeps the search vector up to date with a trigger
+POSTGRES_SEARCH_TRIGGER = (
+    "CREATE TRIGGER posts_search_vector_update BEFORE INSERT OR UPDATE "
+    "ON posts FOR EACH ROW EXECUTE PROCEDURE tsvector_update_trigger("
+    "search_vector, 'pg_catalog.english', title, body)")
+
+# SQLite keeps an external content FTS5 table in step with posts instead
+SQLITE_SEARCH = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5("
+    "title, body, content='posts', content_rowid='id')",
+    "CREATE TRIGGER IF NOT EXISTS posts_fts_insert AFTER INSERT ON posts BEGIN "
+    "INSERT INTO posts_fts(rowid, title, body) "
+    "VALUES (new.id, new.title, new.body); END",
+    "CREATE TRIGGER IF NOT EXISTS posts_fts_delete AFTER DELETE ON posts BEGIN "
+    "INSERT INTO posts_fts(posts_fts, rowid, title, body) "
+    "VALUES ('delete', old.id, old.title, old.body); END",
+    "CREATE TRIGGER IF NOT EXISTS posts_fts_update AFTER UPDATE ON posts BEGIN "
+    "INSERT INTO posts_fts(posts_fts, rowid, title, body) "
+    "VALUES ('delete', old.id, old.title, old.body); "
+    "INSERT INTO posts_fts(rowid, title, body) "
+    "VALUES (new.id, new.title, new.body); END",
+]
+
+def add_columns(connection):
+    """
+    Give a posts table from before version, updated_at and search_vector
+    were added the columns. Only the catalog changes, rather than every row,
+    so the table is locked just for a moment however large it is.
+    """
+    postgres = connection.dialect.name == "postgresql"
+    columns = set(column["name"] for column
+                  in inspect(connection).get_columns("posts"))
+
+    if "version" not in columns:
+        # A constant default is stored once rather than written to each row
+        connection.execute("ALTER TABLE posts ADD COLUMN "
+                           "version INTEGER NOT NULL DEFAULT 1")
+    if "updated_at" not in columns:
+        # Filled in, and made NOT NULL, by 0003
+        connection.execute("ALTER TABLE posts ADD COLUMN updated_at TIMESTAMP")
+    if "search_vector" not in columns:
+        connection.execute("ALTER TABLE posts ADD COLUMN search_vector " +
+                           ("TSVECTOR" if postgres else "TEXT"))
+
+def add_search(connection, rebuild):
+    """
+    Create the triggers which keep posts searchable as they are written,
+    unless they exist already. With rebuild SQLite indexes the posts
+    already in the table.
+    """
+    dialect = connection.dialect.name
+    if dialect == "postgresql":
+        trigger = connection.execute(
+            "SELECT 1 FROM pg_trigger "
+            "WHERE tgname = 'posts_search_vector_update'").scalar()
+        if not trigger:
+            connection.execute(POSTGRES_SEARCH_TRIGGER)
+    elif dialect == "sqlite":
+        for statement in SQLITE_SEARCH:
+            connection.execute(statement)
+        # The update trigger takes a post's old text out of posts_fts, so
+        # posts_fts has to match posts before any post is changed. SQLite
+        # locks the whole database for every write anyway.
+        if rebuild:
+            connection.execute("INSERT INTO posts_fts(posts_fts) VALUES ('rebuild')")
+
+def upgrade(connection):
+    existing = "posts" in inspect(connection).get_table_names()
+    metadata.create_all(connection)
+    if existing:
+        add_columns(connection)
+    add_search(connection, rebuild=existing)
+    # Start the count from however many posts there already are
+    connection.execute("INSERT INTO counters (name, value) "
+                       "SELECT 'posts', count(*) FROM posts WHERE NOT EXISTS "
+                       "(SELECT 1 FROM counters WHERE name = 'posts')")
@@ -0,0 +1,48 @@
+"""
+Add a created_at timestamp to posts, and the indexes that listing and
+ordering posts need. On Postgres the indexes are built CONCURRENTLY so
+that posts can still be written while a large table is indexed.
+"""
+from sqlalchemy import inspect
+
+from posts.migrations import backfill, invalid_index
+
+transactional = False
+
+# Number of ids given a created_at per statement when backfilling, so that
+# no one statement holds locks on a large part of the table
+BACKFILL_BATCH_SIZE = 10000
+
+INDEXES = [
+    ("ix_posts_created_at", "posts (created_at)", "posts (created_at)"),
+    ("ix_posts_updated_at", "posts (updated_at)", "posts (updated_at)"),
+]
+
+def backfill_created_at(connection):
+    """ Give posts made before now a created_at """
+    # Posts made before now are taken to have been created when they were
+    # last updated, which is the closest record there is
+    backfill(connection,
+             "UPDATE posts SET created_at = updated_at "
+             "WHERE id > :start AND id <= :end AND created_at IS NULL",
+             BACKFILL_BATCH_SIZE)
+
+def upgrade(connection):
+    # This migration isn't run in a transaction on Postgres, so everything
+    # it does has to cope with being run again after failing part way
+    postgres = connection.dialect.name == "postgresql"
+
+    columns = [column["name"] for column in inspect(connection).get_columns("posts")]
+    if "created_at" not in columns:
+        connection.execute("ALTER TABLE posts ADD COLUMN created_at TIMESTAMP")
+    backfill_created_at(connection)
+
+    for name, postgres_columns, columns in INDEXES:
+        if postgres:
+            if invalid_index(connection, name):
+                connection.execute("DROP INDEX CONCURRENTLY {}".format(name))
+            connection.execute("CREATE INDEX CONCURRENTLY IF NOT EXISTS "
+                               "{} ON {}".format(name, postgres_columns))
+        else:
+            connection.execute("CREATE INDEX IF NOT EXISTS "
+                               "{} ON {}".format(name, columns))
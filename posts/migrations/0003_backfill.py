@@ -0,0 +1,73 @@
+"""
+Fill in the columns which 0001 added to posts tables from before there were
+migrations, and on Postgres index the existing posts for search and build
+the search index. On Postgres this runs outside a transaction, a range of
+ids at a time, and builds the index CONCURRENTLY, so that posts can still
+be read and written while a large table is brought up to date.
+"""
+import datetime
+
+from sqlalchemy import inspect
+
+from posts.migrations import backfill, invalid_index
+
+transactional = False
+
+# Number of ids filled in per statement
+BACKFILL_BATCH_SIZE = 10000
+
+def backfill_updated_at(connection):
+    """ Give posts from before updated_at was added one """
+    # Existing posts are taken to have been created and last changed now, as
+    # there is no record of when they were. 0002 copied their created_at
+    # from the updated_at they didn't have yet, so that is filled in too.
+    backfill(connection,
+             "UPDATE posts SET updated_at = :now, "
+             "created_at = coalesce(created_at, :now) "
+             "WHERE id > :start AND id <= :end AND updated_at IS NULL",
+             BACKFILL_BATCH_SIZE, now=datetime.datetime.utcnow())
+
+def require_updated_at(connection):
+    """ Make updated_at NOT NULL on Postgres, once every post has one """
+    column = [column for column in inspect(connection).get_columns("posts")
+              if column["name"] == "updated_at"][0]
+    if not column["nullable"]:
+        return
+    # SET NOT NULL on its own scans the table with reads and writes locked
+    # out. Validating a check constraint first only locks out other schema
+    # changes, and lets SET NOT NULL skip the scan.
+    constraint = connection.execute(
+        "SELECT 1 FROM pg_constraint "
+        "WHERE conname = 'posts_updated_at_not_null'").scalar()
+    if not constraint:
+        connection.execute("ALTER TABLE posts ADD CONSTRAINT "
+                           "posts_updated_at_not_null "
+                           "CHECK (updated_at IS NOT NULL) NOT VALID")
+    connection.execute("ALTER TABLE posts VALIDATE CONSTRAINT "
+                       "posts_updated_at_not_null")
+    connection.execute("ALTER TABLE posts ALTER COLUMN updated_at SET NOT NULL")
+    connection.execute("ALTER TABLE posts DROP CONSTRAINT posts_updated_at_not_null")
+
+def index_for_search(connection):
+    """
+    Index the existing posts for search, and build the GIN index which keeps
+    searches from scanning the whole table. SQLite's posts_fts is already
+    rebuilt by 0001.
+    """
+    backfill(connection,
+             "UPDATE posts SET search_vector = to_tsvector("
+             "'pg_catalog.english', coalesce(title, '') || ' ' || "
+             "coalesce(body, '')) "
+             "WHERE id > :start AND id <= :end AND search_vector IS NULL",
+             BACKFILL_BATCH_SIZE)
+    if invalid_index(connection, "ix_posts_search_vector"):
+        connection.execute("DROP INDEX CONCURRENTLY ix_posts_search_vector")
+    connection.execute("CREATE INDEX CONCURRENTLY IF NOT EXISTS "
+                       "ix_posts_search_vector ON posts USING gin(search_vector)")
+
+def upgrade(connection):
+    # Like 0002 this has to cope with being run again after failing part way
+    backfill_updated_at(connection)
+    if connection.dialect.name == "postgresql":
+        require_updated_at(connection)
+        index_for_search(connection)
@@ -0,0 +1,18 @@
+"""
+The write_statuses table, where the outcome of each write queued in
+write-behind mode is kept so that any worker can answer for it
+"""
+from sqlalchemy import MetaData, Table, Column, Integer, String, Text, DateTime
+
+metadata = MetaData()
+
+write_statuses = Table("write_statuses", metadata,
+    Column("ticket", String(32), primary_key=True),
+    Column("post_id", Integer, nullable=False),
+    Column("status", String(16), nullable=False),
+    Column("message", Text),
+    Column("created_at", DateTime, nullable=False, index=True)
+)
+
+def upgrade(connection):
+    metadata.create_all(connection)
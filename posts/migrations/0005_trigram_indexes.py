@@ -0,0 +1,32 @@
+"""
+Trigram indexes on the title and body of posts, which title_like and
+body_like filters use on Postgres. They match text anywhere in a post, with
+LIKE '%term%', which no btree index can help with. This replaces the
+title index from 0002, which only helped LIKE 'term%'. The indexes are built
+CONCURRENTLY, so that posts can still be written while a large table is
+indexed.
+"""
+from posts.migrations import invalid_index
+
+transactional = False
+
+INDEXES = [
+    ("ix_posts_title_trgm", "posts USING gin (title gin_trgm_ops)"),
+    ("ix_posts_body_trgm", "posts USING gin (body gin_trgm_ops)"),
+]
+
+def upgrade(connection):
+    if connection.dialect.name != "postgresql":
+        # Nothing indexes LIKE '%term%' elsewhere, so the title index only
+        # slowed writes down
+        connection.execute("DROP INDEX IF EXISTS ix_posts_title")
+        return
+
+    # Like 0002 this has to cope with being run again after failing part way
+    connection.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    for name, definition in INDEXES:
+        if invalid_index(connection, name):
+            connection.execute("DROP INDEX CONCURRENTLY {}".format(name))
+        connection.execute("CREATE INDEX CONCURRENTLY IF NOT EXISTS "
+                           "{} ON {}".format(name, definition))
+    connection.execute("DROP INDEX CONCURRENTLY IF EXISTS ix_posts_title")
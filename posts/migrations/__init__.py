@@ -0,0 +1,89 @@
+"""
+Versioned schema migrations. Each migration is a module in this package
+named NNNN_description.py, with an upgrade(connection) function. Migrations
+which set transactional = False run outside a transaction on Postgres, so
+that they can build indexes CONCURRENTLY without locking out writes.
+"""
+import os
+import re
+import datetime
+import importlib
+
+from sqlalchemy import Table, Column, Integer, DateTime, text
+
+from posts.database import Base
+
+# The migrations which have been applied to the database
+schema_version = Table("schema_version", Base.metadata,
+    Column("version", Integer, primary_key=True),
+    Column("applied_at", DateTime, nullable=False,
+           default=datetime.datetime.utcnow)
+)
+
+def backfill(connection, statement, batch_size, **params):
+    """
+    Run an UPDATE of posts a range of ids at a time, so that on a large table
+    no one statement holds locks on much of it. The statement picks out its
+    range with id > :start AND id <= :end.
+    """
+    last_id = connection.execute("SELECT max(id) FROM posts").scalar() or 0
+    start = 0
+    while start < last_id:
+        connection.execute(text(statement), start=start,
+                           end=start + batch_size, **params)
+        start += batch_size
+
+def invalid_index(connection, name):
+    """ Whether a CREATE INDEX CONCURRENTLY which failed left the index INVALID """
+    return connection.execute(text(
+        "SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid "
+        "WHERE pg_class.relname = :name AND NOT pg_index.indisvalid"),
+        name=name).scalar() is not None
+
+def migrations():
+    """ The (version, module) of every migration, in order """
+    found = []
+    for filename in os.listdir(os.path.dirname(__file__)):
+        match = re.match(r"^(\d{4})_\w+\.py$", filename)
+        if match:
+            module = importlib.import_module("posts.migrations." + filename[:-3])
+            found.append((int(match.group(1)), module))
+    return sorted(found)
+
+def applied(engine):
+    """ The versions which have already been applied to the database """
+    schema_version.create(engine, checkfirst=True)
+    return set(row[0] for row in engine.execute(schema_version.select()))
+
+def migrate(engine, target=None):
+    """
+    Apply each migration which hasn't been applied yet, up to and including
+    target. Returns the versions which were applied.
+    """
+    done = applied(engine)
+    versions = []
+    for version, module in migrations():
+        if version in done or target is not None and version > target:
+            continue
+        if getattr(module, "transactional", True) or engine.dialect.name != "postgresql":
+            with engine.begin() as connection:
+                module.upgrade(connection)
+                connection.execute(schema_version.insert(), version=version)
+        else:
+            connection = engine.connect().execution_options(
+                isolation_level="AUTOCOMMIT")
+            try:
+                module.upgrade(connection)
+                connection.execute(schema_version.insert(), version=version)
+            finally:
+                connection.close()
+        versions.append(version)
+    return versions
+
+def main():
+    """ Bring the configured database, and any shards, up to date """
+    from posts import create_app
+    from posts.database import get_database
+    for engine in get_database(create_app()).shards:
+        for version in migrate(engine):
+            print("Applied migration {:04d} to {}".format(version, engine.url))
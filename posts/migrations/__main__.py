@@ -0,0 +1,3 @@
+from posts.migrations import main
+
+main()
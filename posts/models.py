@@ -1,4 +1,8 @@
-from sqlalchemy import Column, Integer, String, Sequence
+import datetime
+
+from sqlalchemy import Column, Integer, BigInteger, String, Sequence, Text, DateTime, DDL, event
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.orm import deferred
 
 from database import Base
 
@@ -8,7 +12,23 @@ class Post(Base):
     id = Column(Integer, primary_key=True)
     title = Column(String(128))
     body = Column(String(1024))
-    
+    # Bumped on every change, so together with the id it identifies one
+    # revision of a post for ETags
+    version = Column(Integer, nullable=False)
+    # Posts from before created_at was added have it backfilled from
+    # updated_at, so it is never null in practice
+    created_at = Column(DateTime, index=True, default=datetime.datetime.utcnow)
+    updated_at = Column(DateTime, nullable=False, index=True,
+                        default=datetime.datetime.utcnow,
+                        onupdate=datetime.datetime.utcnow)
+    # Full text search document for the title and body. Only Postgres has a
+    # tsvector type, other databases search through posts_fts instead
+    search_vector = deferred(Column(Text().with_variant(TSVECTOR(), "postgresql")))
+
+    # The trigram indexes which title_like and body_like filters use are
+    # Postgres only, and are created by migration 0005
+    __mapper_args__ = {"version_id_col": version}
+
     def as_dictionary(self):
         post = {
             "id": self.id,
@@ -16,3 +36,82 @@ class Post(Base):
             "body": self.body
         }
         return post
+
+class Counter(Base):
+    """ Running totals, kept in step with the tables they count """
+    __tablename__ = "counters"
+
+    name = Column(String(64), primary_key=True)
+    value = Column(BigInteger, nullable=False, default=0)
+
+def adjust_post_count(connection, delta):
+    """ Add delta to the count of posts, in the same transaction as the change """
+    connection.execute(Counter.__table__.update()
+                       .where(Counter.name == "posts")
+                       .values(value=Counter.value + delta))
+
+@event.listens_for(Post, "after_insert")
+def count_insert(mapper, connection, target):
+    adjust_post_count(connection, 1)
+
+@event.listens_for(Post, "after_delete")
+def count_delete(mapper, connection, target):
+    adjust_post_count(connection, -1)
+
+class PostChange(Base):
+    """
+    One entry in the change feed. Entries are numbered in the order they were
+    written, and deletes are kept as tombstones so that consumers can mirror
+    the posts table by replaying everything after the last seq they saw.
+    """
+    __tablename__ = "post_changes"
+
+    seq = Column(Integer, primary_key=True)
+    post_id = Column(Integer, nullable=False)
+    op = Column(String(16), nullable=False)
+    changed_at = Column(DateTime, nullable=False,
+                        default=datetime.datetime.utcnow)
+
+def record_changes(connection, op, ids):
+    """ Add entries to the change feed, in the same transaction as the changes """
+    # A seq is handed out when its entry is inserted, not when it commits, so
+    # a consumer could see a later seq before an earlier one and skip past
+    # it. Holding the posts counter row lock until commit stops any other
+    # writer taking a seq in the meantime, so seqs commit in order.
+    adjust_post_count(connection, 0)
+    connection.execute(PostChange.__table__.insert(),
+                       [{"post_id": id, "op": op} for id in ids])
+
+@event.listens_for(Post, "after_insert")
+def record_insert(mapper, connection, target):
+    record_changes(connection, "create", [target.id])
+
+@event.listens_for(Post, "after_update")
+def record_update(mapper, connection, target):
+    record_changes(connection, "update", [target.id])
+
+@event.listens_for(Post, "after_delete")
+def record_delete(mapper, connection, target):
+    record_changes(connection, "delete", [target.id])
+
+class WriteStatus(Base):
+    """
+    The outcome of a write queued in write-behind mode, kept in the database
+    so that any worker can answer for it. Each is kept on the database the
+    post is written to, and is marked committed in the same transaction as
+    the write.
+    """
+    __tablename__ = "write_statuses"
+
+    ticket = Column(String(32), primary_key=True)
+    post_id = Column(Integer, nullable=False)
+    # "pending", "committed" or "failed", with the reason in message
+    status = Column(String(16), nullable=False)
+    message = Column(Text)
+    created_at = Column(DateTime, nullable=False, index=True,
+                        default=datetime.datetime.utcnow)
+
+# The full text search index and its triggers are created by the first
+# migration. SQLite's FTS5 table has to be dropped along with posts.
+event.listen(Post.__table__, "before_drop",
+             DDL("DROP TABLE IF EXISTS posts_fts").execute_if(dialect="sqlite"))
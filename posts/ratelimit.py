@@ -0,0 +1,184 @@
+import math
+import time
+import threading
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+from flask import g, request, current_app, Response
+
+import codec
+import instrumentation
+from instrumentation import registry
+
+class MemoryBuckets(object):
+    """
+    In-process token buckets, one per key. The least recently used buckets
+    are forgotten beyond max_size of them, which only lets those clients
+    start again with a full bucket.
+    """
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        """
+        Take a token from a bucket holding up to burst tokens and refilling
+        at rate tokens a second. Returns 0 if there was one, or else the
+        number of seconds until there will be.
+        """
+        now = time.time()
+        with self.lock:
+            tokens, updated = self.buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            wait = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self.buckets[key] = (tokens, now)
+            while len(self.buckets) > self.max_size:
+                self.buckets.popitem(last=False)
+        return wait
+
+    def clear(self):
+        with self.lock:
+            self.buckets.clear()
+
+# Refills and takes from a bucket atomically, so that workers sharing it
+# can't both spend the same token
+TAKE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "updated")
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(now - updated, 0) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call("HMSET", KEYS[1], "tokens", tokens, "updated", now)
+redis.call("EXPIRE", KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+class RedisBuckets(object):
+    """
+    Token buckets shared between processes through Redis, so that a client
+    is limited however its requests are spread across workers
+    """
+    def __init__(self, url, prefix="posts:ratelimit:"):
+        if redis is None:
+            raise RuntimeError("The redis rate limit backend needs the redis package")
+        self.client = redis.StrictRedis.from_url(url)
+        self.script = self.client.register_script(TAKE_SCRIPT)
+        self.prefix = prefix
+
+    def take(self, key, rate, burst):
+        return float(self.script(keys=[self.prefix + key],
+                                 args=[rate, burst, time.time()]))
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + "*"):
+            self.client.delete(key)
+
+def make_buckets(config):
+    """ Create the token bucket backend named by the RATE_LIMIT_BACKEND setting """
+    if config["RATE_LIMIT_BACKEND"] == "redis":
+        return RedisBuckets(config["RATE_LIMIT_REDIS_URL"])
+    return MemoryBuckets(config["RATE_LIMIT_MAX_CLIENTS"])
+
+class ConcurrencyLimit(object):
+    """
+    Lets at most limit requests run at once. Up to queue_size more can wait
+    for one of them to finish, and any beyond that are turned away at once.
+    """
+    def __init__(self, limit, queue_size):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.active = 0
+        self.waiting = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, timeout):
+        """ Wait up to timeout seconds for a slot, returning whether one was got """
+        deadline = time.time() + timeout
+        with self.condition:
+            if self.active >= self.limit:
+                if self.waiting >= self.queue_size:
+                    return False
+                self.waiting += 1
+                try:
+                    while self.active >= self.limit:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            return False
+                        self.condition.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            self.active += 1
+            return True
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+def rejected(status, message, retry_after, reason):
+    """ Turn a request away, telling the client when to try again """
+    if instrumentation.enabled():
+        registry.increment("posts_rejected_requests_total",
+                           route=instrumentation.route(), reason=reason)
+    data = codec.dumps({"message": message})
+    headers = {"Retry-After": str(int(math.ceil(retry_after)))}
+    return Response(data, status, headers=headers, mimetype="application/json")
+
+def admit():
+    """
+    Turn away requests from clients which are over their rate limit for the
+    route, and requests to busy routes which can't get a slot in time
+    """
+    if request.endpoint is None:
+        return None
+    config = current_app.config
+    route = instrumentation.route()
+
+    limit = config["RATE_LIMITS"].get(route, config["RATE_LIMIT_DEFAULT"])
+    if limit is not None:
+        rate, burst = limit
+        key = "{}:{}".format(request.remote_addr, route)
+        wait = current_app.extensions["buckets"].take(key, rate, burst)
+        if wait:
+            return rejected(429, "Too many requests", wait, "rate_limit")
+
+    concurrency = current_app.extensions["concurrency"].get(route)
+    if concurrency is not None:
+        if not concurrency.acquire(config["CONCURRENCY_WAIT"]):
+            return rejected(503, "Too many requests in progress",
+                            config["CONCURRENCY_WAIT"], "concurrency")
+        g.concurrency = concurrency
+    return None
+
+def release(exception=None):
+    """ Give back the slot a request held, once its response has been sent """
+    concurrency = g.get("concurrency")
+    if concurrency is not None:
+        g.concurrency = None
+        concurrency.release()
+
+def init_app(app):
+    """ Give an app its rate limits and concurrency caps """
+    app.extensions["buckets"] = make_buckets(app.config)
+    app.extensions["concurrency"] = dict(
+        (route, ConcurrencyLimit(limit, app.config["CONCURRENCY_QUEUE_SIZE"]))
+        for route, limit in app.config["CONCURRENCY_LIMITS"].items())
+    app.before_request(admit)
+    app.teardown_request(release)
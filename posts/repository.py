@@ -0,0 +1,605 @@
+import re
+import bisect
+import datetime
+import threading
+from collections import namedtuple
+
+from flask import current_app
+from sqlalchemy import func
+from sqlalchemy.orm.exc import StaleDataError
+from werkzeug.local import LocalProxy
+
+import bulk
+import codec
+import models
+import search
+import sharding
+import instrumentation
+from database import session
+
+class Conflict(Exception):
+    """
+    Raised when a post was changed or deleted by someone else between being
+    read and written
+    """
+
+class Repository(object):
+    """
+    Where posts are kept. The API only reaches posts through these methods,
+    so any backend which has them can stand in for another. Posts are
+    objects with the attributes of a models.Post, and rows are tuples of
+    the requested fields which can also be read as attributes.
+    """
+    # Whether posts can only be read, which turns writes away with a 405
+    read_only = False
+
+    def stamp(self):
+        """
+        The number of posts and when one was last changed, which together
+        change whenever a post is added, edited or deleted
+        """
+        raise NotImplementedError
+
+    def list(self, fields, title_like=None, body_like=None, q=None,
+             after=None, limit=None, stream=False):
+        """
+        Rows of the given fields, then the id, for the posts matching the
+        filters. They come in id order after the after cursor, or best
+        search match first. Streamed rows may be read as they are needed.
+        """
+        raise NotImplementedError
+
+    def count(self, title_like=None, body_like=None, q=None, approximate=False):
+        """
+        The number of posts matching the filters, and whether it is only an
+        estimate, as approximate lets it be
+        """
+        raise NotImplementedError
+
+    def get(self, id, fields):
+        """
+        A row of the given fields for one post, then its id if that wasn't
+        asked for, its version and updated_at, or None if there is no such
+        post
+        """
+        raise NotImplementedError
+
+    def post(self, id):
+        """ The whole of one post, to be edited or deleted, or None """
+        raise NotImplementedError
+
+    def create(self, title, body):
+        """ Add a post, returning it """
+        raise NotImplementedError
+
+    def update(self, post, title, body):
+        """
+        Change a post, bumping its version, and return it. Raises a Conflict
+        if the post has changed since it was read.
+        """
+        raise NotImplementedError
+
+    def delete(self, post):
+        """ Delete a post, raising a Conflict if it has changed since it was read """
+        raise NotImplementedError
+
+    def bulk(self, operations):
+        """
+        Apply a chunk of validated (op, id, data) operations, returning a
+        result with the HTTP status of each one
+        """
+        raise NotImplementedError
+
+    def has_changes(self):
+        """ Whether there is a change feed to read """
+        raise NotImplementedError
+
+    def changes(self, since, limit):
+        """
+        Up to limit entries from the change feed after since, each with the
+        current state of its post, or None for the post if it has been
+        deleted
+        """
+        raise NotImplementedError
+
+    def export(self):
+        """ Every post, in id order """
+        raise NotImplementedError
+
+class SQLRepository(Repository):
+    """
+    Posts kept in the database, and spread across its shards if there are
+    any. This is what the API uses unless STORAGE_BACKEND says otherwise.
+    """
+
+    def __init__(self, preview_length=140):
+        self.preview_length = preview_length
+
+    def columns(self, fields):
+        """
+        The columns to select for the given fields, so that only those are
+        read from the database. The id is always selected, after the
+        requested fields if it isn't one of them, since pagination and ETags
+        need it.
+        """
+        columns = []
+        for field in fields:
+            if field == "body_preview":
+                # Truncate the body in the database rather than reading it all
+                column = func.substr(models.Post.body, 1,
+                                     self.preview_length).label(field)
+            else:
+                column = getattr(models.Post, field)
+            columns.append(column)
+        if "id" not in fields:
+            columns.append(models.Post.id)
+        return columns
+
+    def filter(self, posts, title_like=None, body_like=None):
+        """ Filter a query of posts by the title_like and body_like arguments """
+        if title_like:
+            posts = posts.filter(models.Post.title.contains(title_like))
+        if body_like:
+            posts = posts.filter(models.Post.body.contains(body_like))
+        return posts
+
+    def post_count(self):
+        """ Query for the number of posts, read from the counter row """
+        return session.query(models.Counter.value).filter(
+            models.Counter.name == "posts")
+
+    def stamp(self):
+        """
+        The number of posts and when one was last changed, read from an
+        aggregate over the table rather than from the rows
+        """
+        query = session.query(self.post_count().as_scalar(),
+                              func.max(models.Post.updated_at))
+        rows = [rows[0] for rows in sharding.fan_out(query)]
+        count = sum(count for count, updated_at in rows)
+        updated_at = max(updated_at for count, updated_at in rows)
+        return count, updated_at
+
+    def list(self, fields, title_like=None, body_like=None, q=None,
+             after=None, limit=None, stream=False):
+        """
+        Rows of the given fields for the posts matching the filters, in id
+        order after the after cursor, or best search match first. Streamed
+        rows are read a batch at a time rather than all at once.
+        """
+        posts = session.query(*self.columns(fields))
+        posts = self.filter(posts, title_like, body_like)
+        if q:
+            posts = search.search(posts, q)
+        else:
+            # Walk the posts in id order, starting just after the cursor, so
+            # that every page is an index range scan rather than an OFFSET
+            posts = posts.order_by(models.Post.id)
+            if after is not None:
+                posts = posts.filter(models.Post.id > after)
+        if limit is not None:
+            posts = posts.limit(limit)
+        if stream:
+            return sharding.stream(posts, current_app.config["STREAM_BATCH_SIZE"],
+                                   ordered=not q)
+        return sharding.fetch(posts, ordered=not q)
+
+    def estimate_count(self, query):
+        """
+        The planner's estimate of how many rows a query returns, or None if
+        the database can't give one cheaply
+        """
+        if sharding.sharded():
+            return None
+        connection = session.connection(mapper=models.Post)
+        if connection.dialect.name != "postgresql":
+            return None
+        compiled = query.statement.compile(dialect=connection.dialect)
+        result = connection.execute("EXPLAIN (FORMAT JSON) " + str(compiled),
+                                    compiled.params)
+        plan = result.scalar()
+        if isinstance(plan, basestring):
+            plan = codec.loads(plan)
+        return int(plan[0]["Plan"]["Plan Rows"])
+
+    def count(self, title_like=None, body_like=None, q=None, approximate=False):
+        """
+        The number of posts matching the filters, and whether it is only the
+        planner's estimate
+        """
+        if not (title_like or body_like or q):
+            # The total comes straight from the counter on each shard
+            return sum(rows[0][0] for rows in sharding.fan_out(self.post_count())), False
+
+        posts = self.filter(session.query(models.Post.id), title_like, body_like)
+        if q:
+            posts = search.search(posts, q).order_by(None)
+        if approximate:
+            count = self.estimate_count(posts)
+            if count is not None:
+                return count, True
+        posts = posts.with_entities(func.count(models.Post.id))
+        return sum(rows[0][0] for rows in sharding.fan_out(posts)), False
+
+    def get(self, id, fields):
+        """
+        A row of the given fields for one post, followed by its version and
+        updated_at, or None if there is no such post
+        """
+        columns = self.columns(fields) + [models.Post.version,
+                                          models.Post.updated_at]
+        post = session.query(*columns).filter(models.Post.id == id)
+        return next(iter(instrumentation.fetch(post.limit(1))), None)
+
+    def post(self, id):
+        """ The whole of one post, to be edited or deleted, or None """
+        return session.query(models.Post).get(id)
+
+    def create(self, title, body):
+        """
+        Add a post. Sharded posts need their id up front to know which shard
+        to go on.
+        """
+        post = models.Post(title=title, body=body)
+        if sharding.sharded():
+            post.id = sharding.allocate_ids(1)[0]
+            sharding.use_shard(post.id)
+        session.add(post)
+        session.commit()
+        return post
+
+    def update(self, post, title, body):
+        post.title = title
+        post.body = body
+        self.commit()
+        return post
+
+    def delete(self, post):
+        session.delete(post)
+        self.commit()
+
+    def commit(self):
+        """
+        Commit a change to one post. Updates and deletes only match the
+        version of the post which was read, so a post another request has
+        changed since is left alone.
+        """
+        try:
+            session.commit()
+        except StaleDataError as error:
+            session.rollback()
+            raise Conflict(str(error))
+
+    def bulk(self, operations):
+        """ Apply a chunk of validated (op, id, data) operations """
+        return bulk.apply_to_shards(session, operations)
+
+    def has_changes(self):
+        """
+        Whether there is a change feed. Each shard numbers its own changes,
+        so there is no one sequence to follow once posts are sharded.
+        """
+        return not sharding.sharded()
+
+    def changes(self, since, limit):
+        """
+        Up to limit entries from the change feed after since, each with the
+        current state of its post, or None for the post if it has been
+        deleted
+        """
+        query = session.query(models.PostChange.seq, models.PostChange.op,
+                              models.PostChange.post_id, models.Post.id,
+                              models.Post.title, models.Post.body)
+        query = query.outerjoin(models.Post,
+                                models.Post.id == models.PostChange.post_id)
+        query = query.filter(models.PostChange.seq > since)
+        changes = []
+        query = query.order_by(models.PostChange.seq).limit(limit)
+        for seq, op, id, post_id, title, body in query:
+            post = None
+            if op != "delete" and post_id is not None:
+                post = {"id": id, "title": title, "body": body}
+            changes.append({"seq": seq, "op": op, "id": id, "post": post})
+        # End the transaction so the next poll sees newly committed changes
+        session.close()
+        return changes
+
+    def export(self):
+        """ Every post, in id order, read a batch at a time """
+        posts = session.query(models.Post).order_by(models.Post.id)
+        return sharding.stream(posts, current_app.config["STREAM_BATCH_SIZE"])
+
+class PostRecord(object):
+    """ One post in a MemoryRepository, with the same attributes as a Post """
+    __slots__ = ("id", "title", "body", "version", "created_at", "updated_at")
+
+    def __init__(self, id, title, body, version=1, created_at=None,
+                 updated_at=None):
+        self.id = id
+        self.title = title
+        self.body = body
+        self.version = version
+        self.created_at = created_at
+        self.updated_at = updated_at
+
+    def as_dictionary(self):
+        return {"id": self.id, "title": self.title, "body": self.body}
+
+# Words, as they are indexed. Searches for text which isn't a whole word
+# look through the words containing it.
+TOKEN = re.compile(r"\w+", re.UNICODE)
+
+class ReadOnly(Exception):
+    """ Raised when writing to a repository which only serves reads """
+
+class MemoryRepository(Repository):
+    """
+    Posts kept in this process, for tests and for read-only edge replicas
+    hydrated from a snapshot. Posts are found by id through a dict, listed
+    in order through a sorted list of ids, and filtered through an inverted
+    index from the words of each title and body to the posts they are in.
+    Searches match every term anywhere in the title or body, like the
+    fallback search over databases without a search index.
+    """
+    def __init__(self, preview_length=140, read_only=False):
+        self.preview_length = preview_length
+        self.read_only = read_only
+        self.posts = {}
+        self.ids = []
+        self.index = {"title": {}, "body": {}}
+        self.log = []
+        # Ids are never reused, even once the newest post is deleted, so
+        # that an ETag or change feed entry only ever means one post
+        self.next_id = 1
+        self.updated_at = None
+        self.rows = {}
+        self.lock = threading.RLock()
+
+    def add_words(self, record):
+        for field, index in self.index.items():
+            for word in set(TOKEN.findall(getattr(record, field).lower())):
+                index.setdefault(word, set()).add(record.id)
+
+    def remove_words(self, record):
+        for field, index in self.index.items():
+            for word in set(TOKEN.findall(getattr(record, field).lower())):
+                ids = index[word]
+                ids.discard(record.id)
+                if not ids:
+                    del index[word]
+
+    def candidates(self, field, text):
+        """
+        Ids of the posts which may contain text in the given field, or None
+        if the index can't narrow them down. Words inside text must appear
+        whole, while those at its edges may be part of a longer word.
+        """
+        index = self.index[field]
+        found = None
+        words = sorted(TOKEN.finditer(text.lower()),
+                       key=lambda match: match.start() == 0 or match.end() == len(text))
+        for match in words:
+            word = match.group()
+            if match.start() > 0 and match.end() < len(text):
+                ids = index.get(word, set())
+            else:
+                ids = set()
+                for indexed, posting in index.iteritems():
+                    if word in indexed:
+                        ids |= posting
+            found = ids if found is None else found & ids
+            if not found:
+                break
+        return found
+
+    def matching(self, title_like=None, body_like=None, q=None):
+        """ Ids of the posts matching the filters, in id order """
+        ids = None
+        tests = []
+        for field, text in [("title", title_like), ("body", body_like)]:
+            if text:
+                found = self.candidates(field, text)
+                if found is not None:
+                    ids = found if ids is None else ids & found
+                tests.append(lambda record, field=field, text=text:
+                             text in getattr(record, field))
+        for term in (q or "").split():
+            found = self.candidates("title", term)
+            body = self.candidates("body", term)
+            if found is not None and body is not None:
+                found = found | body
+                ids = found if ids is None else ids & found
+            tests.append(lambda record, term=term:
+                         term in record.title or term in record.body)
+        if not tests:
+            return self.ids
+        if ids is None:
+            ids = self.ids
+        return sorted(id for id in ids
+                      if all(test(self.posts[id]) for test in tests))
+
+    def row(self, record, columns):
+        """ A row of the given columns of a record, like a query returns """
+        Row = self.rows.get(columns)
+        if Row is None:
+            Row = self.rows[columns] = namedtuple("Row", columns)
+        values = []
+        for column in columns:
+            if column == "body_preview":
+                values.append(record.body[:self.preview_length])
+            else:
+                values.append(getattr(record, column))
+        return Row(*values)
+
+    def stamp(self):
+        with self.lock:
+            return len(self.posts), self.updated_at
+
+    def list(self, fields, title_like=None, body_like=None, q=None,
+             after=None, limit=None, stream=False):
+        columns = fields if "id" in fields else fields + ("id",)
+        with self.lock:
+            ids = self.matching(title_like, body_like, q)
+            start = 0 if after is None else bisect.bisect_right(ids, after)
+            end = None if limit is None else start + limit
+            return [self.row(self.posts[id], columns) for id in ids[start:end]]
+
+    def count(self, title_like=None, body_like=None, q=None, approximate=False):
+        with self.lock:
+            return len(self.matching(title_like, body_like, q)), False
+
+    def get(self, id, fields):
+        columns = fields if "id" in fields else fields + ("id",)
+        with self.lock:
+            record = self.posts.get(id)
+            if record is None:
+                return None
+            return self.row(record, columns + ("version", "updated_at"))
+
+    def post(self, id):
+        with self.lock:
+            return self.posts.get(id)
+
+    def changed(self, op, id):
+        """ Note a change in the change feed """
+        self.updated_at = datetime.datetime.utcnow()
+        self.log.append((len(self.log) + 1, op, id))
+
+    def check_writable(self):
+        if self.read_only:
+            raise ReadOnly("Posts can't be changed on a read-only replica")
+
+    def add(self, record):
+        self.posts[record.id] = record
+        bisect.insort(self.ids, record.id)
+        self.add_words(record)
+
+    def create(self, title, body):
+        self.check_writable()
+        now = datetime.datetime.utcnow()
+        with self.lock:
+            id = self.next_id
+            self.next_id += 1
+            record = PostRecord(id, title, body, 1, now, now)
+            self.add(record)
+            self.changed("create", id)
+            return record
+
+    def update(self, post, title, body):
+        self.check_writable()
+        with self.lock:
+            self.remove_words(post)
+            post.title = title
+            post.body = body
+            post.version += 1
+            post.updated_at = datetime.datetime.utcnow()
+            self.add_words(post)
+            self.changed("update", post.id)
+            return post
+
+    def delete(self, post):
+        self.check_writable()
+        with self.lock:
+            self.remove_words(post)
+            del self.posts[post.id]
+            del self.ids[bisect.bisect_left(self.ids, post.id)]
+            self.changed("delete", post.id)
+
+    def bulk(self, operations):
+        self.check_writable()
+        results = []
+        with self.lock:
+            for op, id, data in operations:
+                if op == "create":
+                    record = self.create(data["title"], data["body"])
+                    results.append({"status": 201, "id": record.id})
+                    continue
+                record = self.posts.get(id)
+                if record is None:
+                    message = "Could not find post with id {}".format(id)
+                    results.append({"status": 404, "message": message})
+                elif op == "update":
+                    self.update(record, data["title"], data["body"])
+                    results.append({"status": 200, "id": id})
+                else:
+                    self.delete(record)
+                    results.append({"status": 204, "id": id})
+        return results
+
+    def has_changes(self):
+        return True
+
+    def changes(self, since, limit):
+        with self.lock:
+            changes = []
+            for seq, op, id in self.log[since:since + limit]:
+                record = self.posts.get(id) if op != "delete" else None
+                post = record.as_dictionary() if record is not None else None
+                changes.append({"seq": seq, "op": op, "id": id, "post": post})
+            return changes
+
+    def export(self):
+        with self.lock:
+            return [self.posts[id] for id in self.ids]
+
+    def load(self, lines):
+        """ Replace the posts with those in a snapshot """
+        with self.lock:
+            self.posts, self.ids, self.log = {}, [], []
+            self.index = {"title": {}, "body": {}}
+            for line in lines:
+                if line.strip():
+                    self.add(load_record(line))
+            self.next_id = self.ids[-1] + 1 if self.ids else 1
+            self.updated_at = max([record.updated_at
+                                   for record in self.posts.values()] or [None])
+
+# Timestamps in snapshots, always with microseconds so they read back exactly
+TIMESTAMP = "%Y-%m-%dT%H:%M:%S.%f"
+
+def dump_record(post):
+    """ Serialize a post as one line of a snapshot """
+    return codec.dumps({
+        "id": post.id,
+        "title": post.title,
+        "body": post.body,
+        "version": post.version,
+        "created_at": post.created_at and post.created_at.strftime(TIMESTAMP),
+        "updated_at": post.updated_at.strftime(TIMESTAMP)
+    })
+
+def load_record(line):
+    """ Read a post back from one line of a snapshot """
+    data = codec.loads(line)
+    created_at = data["created_at"]
+    if created_at is not None:
+        created_at = datetime.datetime.strptime(created_at, TIMESTAMP)
+    return PostRecord(data["id"], data["title"], data["body"], data["version"],
+                      created_at,
+                      datetime.datetime.strptime(data["updated_at"], TIMESTAMP))
+
+def write_snapshot(repository, stream):
+    """ Write every post in a repository to a file, one JSON object per line """
+    for post in repository.export():
+        stream.write(dump_record(post) + "\n")
+
+def make_repository(config):
+    """ Create the storage backend named by the STORAGE_BACKEND setting """
+    preview_length = config["BODY_PREVIEW_LENGTH"]
+    if config["STORAGE_BACKEND"] != "memory":
+        return SQLRepository(preview_length)
+    if config["WRITE_BEHIND"]:
+        raise RuntimeError("Write-behind needs the sql storage backend")
+    snapshot = config["STORAGE_SNAPSHOT"]
+    repository = MemoryRepository(preview_length, read_only=bool(snapshot))
+    if snapshot:
+        with open(snapshot) as lines:
+            repository.load(lines)
+    return repository
+
+def init_app(app):
+    """ Give an app the storage backend its config asks for """
+    app.extensions["repository"] = make_repository(app.config)
+
+# Where the current app keeps its posts
+repository = LocalProxy(lambda: current_app.extensions["repository"])
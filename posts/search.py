@@ -0,0 +1,39 @@
+from sqlalchemy import Table, Column, Integer, MetaData, func, literal_column, or_
+
+import models
+
+# The SQLite FTS5 index. It lives outside Base.metadata as it is created by
+# the first migration rather than from the models
+posts_fts = Table("posts_fts", MetaData(),
+    Column("rowid", Integer),
+    Column("rank")
+)
+
+def search(query, q):
+    """
+    Filter a query of posts down to those matching the search terms in q,
+    ordered by relevance
+    """
+    dialect = query.session.get_bind(models.Post).dialect.name
+
+    if dialect == "postgresql":
+        tsquery = func.plainto_tsquery("english", q)
+        rank = func.ts_rank(models.Post.search_vector, tsquery)
+        query = query.filter(models.Post.search_vector.op("@@")(tsquery))
+        return query.order_by(rank.desc(), models.Post.id)
+
+    if dialect == "sqlite":
+        # Quote each term so that FTS5 treats it as a string rather than as
+        # query syntax. The rank column sorts the best match first.
+        terms = " ".join('"{}"'.format(term.replace('"', '""'))
+                         for term in q.split())
+        query = query.join(posts_fts, posts_fts.c.rowid == models.Post.id)
+        query = query.filter(literal_column("posts_fts").match(terms))
+        return query.order_by(posts_fts.c.rank, models.Post.id)
+
+    # Without a search index fall back to matching every term anywhere in
+    # the title or body
+    for term in q.split():
+        query = query.filter(or_(models.Post.title.contains(term),
+                                 models.Post.body.contains(term)))
+    return query.order_by(models.Post.id)
@@ -0,0 +1,148 @@
+import heapq
+import threading
+from itertools import chain, izip_longest
+
+from flask import g, current_app
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+
+import models
+import instrumentation
+from database import Session, get_database
+
+class IdBlocks(object):
+    """
+    Hands out post ids which are unique across every shard. Ids are reserved
+    from a counter on the primary block_size at a time, so that most posts
+    are given an id without a round trip to it.
+    """
+    def __init__(self, database, block_size=100):
+        self.database = database
+        self.block_size = block_size
+        self.next_id = 0
+        self.end = 0
+        self.lock = threading.Lock()
+
+    def reserve(self, count):
+        """ Reserve count ids from the primary, returning the first of them """
+        while True:
+            try:
+                with self.database.engine.begin() as connection:
+                    result = connection.execute(text(
+                        "UPDATE counters SET value = value + :count "
+                        "WHERE name = 'post_ids'"), count=count)
+                    if not result.rowcount:
+                        # The first block starts after the posts already on
+                        # the primary, which before sharding held them all
+                        connection.execute(text(
+                            "INSERT INTO counters (name, value) "
+                            "SELECT 'post_ids', coalesce(max(id), 0) + :count "
+                            "FROM posts"), count=count)
+                    end = connection.execute(text(
+                        "SELECT value FROM counters "
+                        "WHERE name = 'post_ids'")).scalar()
+                return end - count + 1
+            except IntegrityError:
+                # Another process created the counter first, so take the
+                # block from it instead
+                continue
+
+    def allocate(self, count):
+        """ The ids for count new posts """
+        with self.lock:
+            ids = []
+            while len(ids) < count:
+                if self.next_id >= self.end:
+                    size = max(self.block_size, count - len(ids))
+                    self.next_id = self.reserve(size)
+                    self.end = self.next_id + size
+                taken = min(count - len(ids), self.end - self.next_id)
+                ids.extend(range(self.next_id, self.next_id + taken))
+                self.next_id += taken
+            return ids
+
+def sharded():
+    """ Whether the current app spreads posts across several databases """
+    return len(get_database().shards) > 1
+
+def use_shard(id):
+    """ Send the rest of the request's queries to the shard of a post """
+    database = get_database()
+    if len(database.shards) > 1:
+        g.shard = database.shard_for(id)
+
+def allocate_ids(count):
+    """ Globally unique ids for count new posts """
+    return current_app.extensions["ids"].allocate(count)
+
+def run(query, engine):
+    """ Run a query on one shard in a session of its own """
+    session = Session(bind=engine)
+    try:
+        return query.with_session(session).all()
+    finally:
+        session.close()
+
+def fan_out(query):
+    """ Run a query on every shard at once, returning the rows from each """
+    database = get_database()
+    if len(database.shards) == 1:
+        return [query.all()]
+    with instrumentation.phase("fan_out"):
+        futures = [database.executor.submit(run, query, engine)
+                   for engine in database.shards]
+        return [future.result() for future in futures]
+
+def merge(results):
+    """ Merge rows from several shards, each in id order, into id order """
+    decorated = [((row.id, row) for row in rows) for rows in results]
+    return [row for id, row in heapq.merge(*decorated)]
+
+def interleave(results):
+    """
+    Take rows from several shards in turn. Search results are ranked within
+    each shard, and this keeps every shard's best matches near the top.
+    """
+    return [row for row in chain.from_iterable(izip_longest(*results))
+            if row is not None]
+
+def fetch(query, ordered=True):
+    """
+    The rows of a query over posts, from every shard. Ordered queries must be
+    in id order, and are merged back into it.
+    """
+    if not sharded():
+        return instrumentation.fetch(query)
+    results = fan_out(query)
+    return merge(results) if ordered else interleave(results)
+
+def batches(query, engine, batch_size):
+    """ Generator which reads the rows of an id ordered query a batch at a time """
+    after = None
+    while True:
+        batch = query if after is None else query.filter(models.Post.id > after)
+        rows = run(batch.limit(batch_size), engine)
+        for row in rows:
+            yield row
+        if len(rows) < batch_size:
+            return
+        after = rows[-1].id
+
+def stream(query, batch_size, ordered=True):
+    """
+    The rows of a query over posts, read a batch at a time so that memory
+    stays bounded. Ordered queries are merged from every shard in id order.
+    """
+    database = get_database()
+    if len(database.shards) == 1:
+        return query.yield_per(batch_size)
+    if not ordered:
+        return fetch(query, ordered)
+    streams = [((row.id, row) for row in batches(query, engine, batch_size))
+               for engine in database.shards]
+    return (row for id, row in heapq.merge(*streams))
+
+def init_app(app):
+    """ Give an app the allocator for its post ids """
+    app.extensions["ids"] = IdBlocks(get_database(app),
+                                     app.config["SHARD_ID_BLOCK_SIZE"])
@@ -0,0 +1,271 @@
+import time
+import uuid
+import Queue
+import atexit
+import datetime
+import threading
+
+from sqlalchemy import func
+
+import bulk
+import models
+import sharding
+from flask import current_app
+from werkzeug.local import LocalProxy
+
+from database import Session, session, get_database
+from cache import invalidate_post
+
+class QueueFull(Exception):
+    """ Raised when a write can't be queued because too many are waiting """
+
+class WriteBehind(object):
+    """
+    Queue of validated writes which a background thread commits in groups,
+    so that bursts of writes share transactions rather than each waiting on
+    its own commit. The outcome of each write is kept in the database for
+    status_ttl seconds, under the ticket it was given when it was queued, so
+    that whichever worker is asked about a write can answer.
+    """
+    def __init__(self, session_factory, max_size=1000, batch_size=100,
+                 batch_delay=0.05, status_ttl=86400, app=None):
+        self.session_factory = session_factory
+        self.app = app
+        self.queue = Queue.Queue(max_size)
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.status_ttl = status_ttl
+        self.lock = threading.Lock()
+        self.thread = None
+        self.next_id = None
+
+    def start(self):
+        """
+        Start the background thread. This happens on the first write rather
+        than at import, since threads don't survive a fork.
+        """
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def allocate_id(self, session):
+        """
+        Pick the id a new post will have once it is written. Sharded posts
+        take theirs from the blocks shared by every shard. Without a
+        database sequence ids are counted in-process, which is only safe when
+        this queue is the only thing inserting posts.
+        """
+        if sharding.sharded():
+            return sharding.allocate_ids(1)[0]
+        ids = bulk.allocate_ids(session, 1)
+        if ids:
+            return ids[0]
+        with self.lock:
+            if self.next_id is None:
+                self.next_id = session.query(func.max(models.Post.id)).scalar() or 0
+            self.next_id += 1
+            return self.next_id
+
+    def submit(self, op, id, data):
+        """
+        Queue a create or update of a post, returning a ticket to look up
+        its status with. Raises QueueFull if there is no room.
+        """
+        self.start()
+        ticket = uuid.uuid4().hex
+        # The status has to be there before the write is, or the background
+        # thread could commit the write before there is a status to mark
+        self.add_status(ticket, id)
+        try:
+            self.queue.put_nowait((ticket, op, id, data))
+        except Queue.Full:
+            self.remove_status(ticket, id)
+            raise QueueFull()
+        return ticket
+
+    def shard_for(self, id):
+        """
+        The engine a write to a post is made on, or None for the primary when
+        posts aren't sharded
+        """
+        if self.app is not None and sharding.sharded():
+            return get_database().shard_for(id)
+        return None
+
+    def add_status(self, ticket, id):
+        """ Record a write as pending, on the database it will be made on """
+        status_session = self.session_factory(bind=self.shard_for(id))
+        try:
+            status_session.add(models.WriteStatus(ticket=ticket, post_id=id,
+                                                  status="pending"))
+            status_session.commit()
+        finally:
+            status_session.close()
+
+    def remove_status(self, ticket, id):
+        status_session = self.session_factory(bind=self.shard_for(id))
+        try:
+            status_session.query(models.WriteStatus).filter(
+                models.WriteStatus.ticket == ticket).delete()
+            status_session.commit()
+        finally:
+            status_session.close()
+
+    def status(self, ticket):
+        """
+        Whether a write is pending, committed or failed, or None if there is
+        no such write. Its status is on the shard of its post, so every
+        shard is asked.
+        """
+        query = session.query(models.WriteStatus.status, models.WriteStatus.post_id,
+                              models.WriteStatus.message).filter(
+            models.WriteStatus.ticket == ticket)
+        for rows in sharding.fan_out(query):
+            for status, id, message in rows:
+                if message is None:
+                    return {"status": status, "id": id}
+                return {"status": status, "id": id, "message": message}
+        return None
+
+    def set_status(self, session, ticket, error):
+        """ Mark a write committed, or failed with an error, in a session """
+        if error:
+            values = {"status": "failed", "message": error}
+        else:
+            values = {"status": "committed"}
+        session.query(models.WriteStatus).filter(
+            models.WriteStatus.ticket == ticket).update(
+            values, synchronize_session=False)
+
+    def expire_statuses(self, session):
+        """ Forget the statuses of writes queued over status_ttl seconds ago """
+        cutoff = (datetime.datetime.utcnow() -
+                  datetime.timedelta(seconds=self.status_ttl))
+        session.query(models.WriteStatus).filter(
+            models.WriteStatus.created_at < cutoff).delete(
+            synchronize_session=False)
+
+    def write(self, session, op, id, data):
+        """ Make one write in a session, returning an error message if it fails """
+        if op == "create":
+            session.add(models.Post(id=id, title=data["title"], body=data["body"]))
+            return None
+        post = session.query(models.Post).get(id)
+        if not post:
+            return "Could not find post with id {}".format(id)
+        post.title = data["title"]
+        post.body = data["body"]
+        return None
+
+    def apply(self, batch, bind=None):
+        """
+        Commit a batch of writes in one transaction, along with their
+        statuses. If that fails the writes are retried one at a time, so one
+        bad write doesn't sink the rest.
+        """
+        session = self.session_factory(bind=bind)
+        try:
+            try:
+                errors = []
+                for ticket, op, id, data in batch:
+                    error = self.write(session, op, id, data)
+                    self.set_status(session, ticket, error)
+                    errors.append(error)
+                self.expire_statuses(session)
+                session.commit()
+            except Exception:
+                session.rollback()
+                errors = []
+                for ticket, op, id, data in batch:
+                    try:
+                        error = self.write(session, op, id, data)
+                        self.set_status(session, ticket, error)
+                        session.commit()
+                    except Exception as exception:
+                        session.rollback()
+                        error = str(exception)
+                        self.fail(session, ticket, error)
+                    errors.append(error)
+        finally:
+            session.close()
+
+        for (ticket, op, id, data), error in zip(batch, errors):
+            if not error:
+                invalidate_post(id)
+
+    def fail(self, session, ticket, error):
+        """
+        Mark a write which couldn't be committed as failed. If the database
+        can't be reached at all the write is left pending, rather than
+        stopping the background thread.
+        """
+        try:
+            self.set_status(session, ticket, error)
+            session.commit()
+        except Exception:
+            session.rollback()
+
+    def run(self):
+        if self.app is not None:
+            # Writes reach the app's database and cache through its context
+            with self.app.app_context():
+                self.process()
+        else:
+            self.process()
+
+    def process(self):
+        while True:
+            # Wait for a write, then give others batch_delay seconds to join
+            # it in the same transaction
+            batch = [self.queue.get()]
+            deadline = time.time() + self.batch_delay
+            while len(batch) < self.batch_size and None not in batch:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except Queue.Empty:
+                    break
+
+            writes = [write for write in batch if write is not None]
+            if writes and self.app is not None and sharding.sharded():
+                # Each shard's writes share a transaction of their own
+                database = get_database()
+                shards = {}
+                for write in writes:
+                    shards.setdefault(database.shard_for(write[2]), []).append(write)
+                for shard, shard_writes in shards.items():
+                    self.apply(shard_writes, bind=shard)
+            elif writes:
+                self.apply(writes)
+            for write in batch:
+                self.queue.task_done()
+            if None in batch:
+                return
+
+    def flush(self):
+        """ Wait until every queued write has been committed or has failed """
+        if self.thread is not None:
+            self.queue.join()
+
+    def stop(self):
+        """ Commit everything still queued, then stop the background thread """
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.thread = None
+
+def init_app(app):
+    """ Give an app its write-behind queue """
+    writes = WriteBehind(Session, app.config["WRITE_QUEUE_SIZE"],
+                         app.config["WRITE_BATCH_SIZE"],
+                         app.config["WRITE_BATCH_DELAY"],
+                         app.config["WRITE_STATUS_TTL"], app=app)
+    app.extensions["writes"] = writes
+    atexit.register(writes.stop)
+
+# The write-behind queue of the current app
+writes = LocalProxy(lambda: current_app.extensions["writes"])
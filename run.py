@@ -1,10 +1,14 @@
 import os
-from posts import app
+from posts import create_app
+from posts.database import get_database
+from posts.migrations import migrate
 
 def run():
+    app = create_app()
+    for engine in get_database(app).shards:
+        migrate(engine)
     port = int(os.environ.get('PORT', 8080))
     app.run(host='0.0.0.0', port=port)
 
 if __name__ == '__main__':
     run()
-
@@ -0,0 +1,82 @@
+import os
+import multiprocessing
+
+from gunicorn.app.base import BaseApplication
+
+from posts import create_app
+from posts.cache import share_between_workers
+from posts.database import get_database
+from posts.migrations import migrate
+
+def settings(app):
+    """ Gunicorn settings for serving app, taken from the environment """
+    def post_fork(server, worker):
+        """
+        Throw away any pooled connections the worker inherited from the
+        master, so that no two processes ever share a database socket
+        """
+        if os.environ.get("ASYNC"):
+            # psycopg2 blocks the whole event loop unless psycogreen is there
+            # to make it cooperate with gevent
+            try:
+                from psycogreen.gevent import patch_psycopg
+                patch_psycopg()
+            except ImportError:
+                pass
+        get_database(app).dispose()
+
+    def worker_exit(server, worker):
+        """ Commit any writes still queued in write-behind mode before exiting """
+        app.extensions["writes"].stop()
+
+    workers = os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1)
+    options = {
+        "bind": "0.0.0.0:{}".format(os.environ.get("PORT", 8080)),
+        "workers": int(workers),
+        "threads": int(os.environ.get("THREADS", 4)),
+        "keepalive": int(os.environ.get("KEEPALIVE", 5)),
+        "timeout": int(os.environ.get("TIMEOUT", 30)),
+        # Workers get this long to finish their requests on a graceful
+        # reload (SIGHUP) or shutdown before they are killed
+        "graceful_timeout": int(os.environ.get("GRACEFUL_TIMEOUT", 30)),
+        # Restart workers after this many requests to bound any slow leaks
+        "max_requests": int(os.environ.get("MAX_REQUESTS", 0)),
+        # Load the app once in the master so workers fork with it ready
+        "preload_app": True,
+        "post_fork": post_fork,
+        "worker_exit": worker_exit
+    }
+
+    # Async mode runs each worker as a gevent event loop, for deployments
+    # which spend most of their time waiting on I/O
+    if os.environ.get("ASYNC"):
+        options["worker_class"] = "gevent"
+        options["worker_connections"] = int(os.environ.get("WORKER_CONNECTIONS", 1000))
+    return options
+
+class Server(BaseApplication):
+    """ Runs the app under gunicorn with the given settings """
+    def __init__(self, app, options):
+        self.app = app
+        self.options = options
+        super(Server, self).__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.app
+
+def run():
+    app = create_app()
+    # Migrate once in the master, before any workers start
+    for engine in get_database(app).shards:
+        migrate(engine)
+    options = settings(app)
+    if options["workers"] > 1:
+        share_between_workers(app)
+    Server(app, options).run()
+
+if __name__ == '__main__':
+    run()
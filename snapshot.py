@@ -0,0 +1,13 @@
+import sys
+from posts import create_app
+from posts.repository import repository, write_snapshot
+
+def run():
+    """ Write every post to the file named on the command line """
+    app = create_app()
+    with app.app_context():
+        with open(sys.argv[1], "w") as stream:
+            write_snapshot(repository, stream)
+
+if __name__ == '__main__':
+    run()
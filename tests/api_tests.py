@@ -1,23 +1,54 @@
 import unittest
 import os
 import json
+import zlib
+import shutil
+import tempfile
+from functools import wraps
 from urlparse import urlparse
 
+from sqlalchemy import event
+from sqlalchemy.exc import SQLAlchemyError
+
 # Configure our app to use the testing databse
 os.environ["CONFIG_PATH"] = "posts.config.TestingConfig"
 
-from posts import app
+from posts import create_app
+from posts.config import TestingConfig
 from posts import models
-from posts.database import Base, engine, session
+from posts.database import Base, engine, session, Session, get_database
+from posts.migrations import migrate
+from posts.cache import cache
+from posts.instrumentation import registry
+from posts.writeback import WriteBehind, QueueFull, writes
+from posts.ratelimit import ConcurrencyLimit
+from posts.repository import repository
+
+app = create_app()
+
+def sql_only(test):
+    """ Skip a test of something only the database backend does """
+    @wraps(test)
+    def wrapper(self):
+        if self.app.config["STORAGE_BACKEND"] != "sql":
+            raise unittest.SkipTest("Only the database backend does this")
+        return test(self)
+    return wrapper
 
 class TestAPI(unittest.TestCase):
     """ Tests for the posts API """
 
+    def createApp(self):
+        return app
+
     def setUp(self):
         """ Test setup """
-        self.client = app.test_client()
+        self.app = self.createApp()
+        self.client = self.app.test_client()
+        self.context = self.app.app_context()
+        self.context.push()
         # Set up the tables in the database
-        Base.metadata.create_all(engine)
+        migrate(engine)
         
     def testGetEmptyPosts(self):
         """ Getting posts from an empty database """
@@ -33,11 +64,9 @@ class TestAPI(unittest.TestCase):
         
     def testGetPosts(self):
         """ Getting posts from a populated database """
-        postA = models.Post(title="Example Post A", body="Just a test")
-        postB = models.Post(title="Example Post B", body="Still a test")
+        postA = repository.create("Example Post A", "Just a test")
+        postB = repository.create("Example Post B", "Still a test")
 
-        session.add_all([postA, postB])
-        session.commit()
 
         response = self.client.get("/api/posts",
             headers=[("Accept", "application/json")]
@@ -59,10 +88,8 @@ class TestAPI(unittest.TestCase):
         
     def testGetPost(self):
         """ Getting a single post from a populated database """
-        postA = models.Post(title="Example Post A", body="Just a test")
-        postB = models.Post(title="Example Post B", body="Still a test")
-        session.add_all([postA, postB])
-        session.commit()
+        postA = repository.create("Example Post A", "Just a test")
+        postB = repository.create("Example Post B", "Still a test")
 
         response = self.client.get("/api/posts/{}".format(postB.id), headers=[("Accept", "application/json")])
 
@@ -77,10 +104,8 @@ class TestAPI(unittest.TestCase):
         """ Deleting a single post from a populated database """
         
         # Adding posts to delete one
-        postA = models.Post(title="Example Post A", body="Just a test")
-        postB = models.Post(title="Example Post B", body="Still a test")
-        session.add_all([postA, postB])
-        session.commit()
+        postA = repository.create("Example Post A", "Just a test")
+        postB = repository.create("Example Post B", "Still a test")
         
         # Deleting the post
         response = self.client.delete("/api/posts/{}".format(postB.id), headers=[("Accept", "application/json")])
@@ -100,11 +125,9 @@ class TestAPI(unittest.TestCase):
         """ Filtering posts by title """
         
         # Adding all the posts
-        postA = models.Post(title="Post with bells", body="Just a bells test")
-        postB = models.Post(title="Post with whistles", body="Still a whistles test")
-        postC = models.Post(title="Post with bells and whistles", body="Another bells test")
-        session.add_all([postA, postB, postC])
-        session.commit()
+        postA = repository.create("Post with bells", "Just a bells test")
+        postB = repository.create("Post with whistles", "Still a whistles test")
+        postC = repository.create("Post with bells and whistles", "Another bells test")
 
         # Getting a response for posts with title like "whistles"
         response = self.client.get("/api/posts?title_like=whistles", headers=[("Accept", "application/json")])
@@ -128,11 +151,9 @@ class TestAPI(unittest.TestCase):
         """ Filtering posts by body """
         
         # Adding all the posts
-        postA = models.Post(title="Post with bells", body="Just a bells test")
-        postB = models.Post(title="Post with whistles", body="Still a whistles test")
-        postC = models.Post(title="Post with bells and whistles", body="Another bells test")
-        session.add_all([postA, postB, postC])
-        session.commit()
+        postA = repository.create("Post with bells", "Just a bells test")
+        postB = repository.create("Post with whistles", "Still a whistles test")
+        postC = repository.create("Post with bells and whistles", "Another bells test")
 
         # Getting the response for posts with body like "bells"
         response = self.client.get("/api/posts?body_like=bells", headers=[("Accept", "application/json")])
@@ -156,11 +177,9 @@ class TestAPI(unittest.TestCase):
         """ Filtering posts by title and body """
 
         # Adding all the posts
-        postA = models.Post(title="Post with bells", body="Just a bells test")
-        postB = models.Post(title="Post with whistles", body="Another whistles test")
-        postC = models.Post(title="Post with bells and whistles", body="Another bells test")
-        session.add_all([postA, postB, postC])
-        session.commit()
+        postA = repository.create("Post with bells", "Just a bells test")
+        postB = repository.create("Post with whistles", "Another whistles test")
+        postC = repository.create("Post with bells and whistles", "Another bells test")
         
         # Getting response for posts with title like "whistles" and body like "bells"
         response = self.client.get("/api/posts?title_like=whistles&body_like=bells", headers=[("Accept", "application/json")])
@@ -199,7 +218,7 @@ class TestAPI(unittest.TestCase):
         self.assertEqual(data["title"], "Example Post")
         self.assertEqual(data["body"], "Just a test")
 
-        posts = session.query(models.Post).all()
+        posts = list(repository.export())
         self.assertEqual(len(posts), 1)
 
         post = posts[0]
@@ -210,9 +229,7 @@ class TestAPI(unittest.TestCase):
         """ Editing a post """
         
         # Adding a post to the database
-        post = models.Post(title="Example Post", body="Just a test")
-        session.add(post)
-        session.commit()
+        post = repository.create("Example Post", "Just a test")
         
         data = {
             "title": "Updated Example Post",
@@ -238,7 +255,7 @@ class TestAPI(unittest.TestCase):
         self.assertEqual(data["body"], "Just an updated test")
 
         # Querying the database to check that our updated post is there
-        posts = session.query(models.Post).all()
+        posts = list(repository.export())
         self.assertEqual(len(posts), 1)
 
         # Checking that the contents of the post in the database matches our updated post
@@ -247,6 +264,59 @@ class TestAPI(unittest.TestCase):
         self.assertEqual(post.body, "Just an updated test")
 
         
+    def editConcurrently(self, id):
+        """
+        Have another session edit a post just after the next request reads
+        it, as if two requests had raced
+        """
+        read = repository.post
+        def post(id):
+            post = read(id)
+            other = Session(bind=get_database(self.app).engine)
+            other.query(models.Post).get(id).title = "Edited elsewhere"
+            other.commit()
+            other.close()
+            return post
+        repository.post = post
+
+    @sql_only
+    def testPutPostConflict(self):
+        """ Editing a post which another request edited since it was read """
+        post = repository.create("Example Post", "Just a test")
+        id = post.id
+
+        self.editConcurrently(id)
+        try:
+            response = self.client.put("/api/post/{}".format(id),
+                data=json.dumps({"title": "Updated Example Post",
+                                 "body": "Just an updated test"}),
+                content_type="application/json",
+                headers=[("Accept", "application/json")]
+            )
+        finally:
+            del repository.post
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(repository.post(id).title, "Edited elsewhere")
+
+    @sql_only
+    def testDeletePostConflict(self):
+        """ Deleting a post which another request edited since it was read """
+        post = repository.create("Example Post", "Just a test")
+        id = post.id
+
+        self.editConcurrently(id)
+        try:
+            response = self.client.delete("/api/posts/{}".format(id),
+                headers=[("Accept", "application/json")]
+            )
+        finally:
+            del repository.post
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(repository.post(id).title, "Edited elsewhere")
+        self.assertEqual(repository.count(), (1, False))
+
     def testGetNonExistentPost(self):
         """ Getting a single post which doesn't exist """
         response = self.client.get("/api/posts/1", headers=[("Accept", "application/json")])
@@ -317,11 +387,968 @@ class TestAPI(unittest.TestCase):
         data = json.loads(response.data)
         self.assertEqual(data["message"], "'body' is a required property")
     
+    def testGetPostsPaginated(self):
+        """ Paging through posts with a cursor """
+        posts = [repository.create("Post {}".format(i), "Just a test")
+                 for i in range(5)]
+
+        # Getting the first page
+        response = self.client.get("/api/posts?limit=2",
+            headers=[("Accept", "application/json")]
+        )
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertEqual([post["title"] for post in data], ["Post 0", "Post 1"])
+
+        # Following the next links until we run out of pages
+        titles = [post["title"] for post in data]
+        while "Link" in response.headers:
+            link = response.headers["Link"]
+            self.assertTrue(link.endswith('; rel="next"'))
+            url = urlparse(link[1:link.index(">")])
+            response = self.client.get("{}?{}".format(url.path, url.query),
+                headers=[("Accept", "application/json")]
+            )
+            self.assertEqual(response.status_code, 200)
+            titles.extend(post["title"] for post in json.loads(response.data))
+
+        self.assertEqual(titles, ["Post {}".format(i) for i in range(5)])
+
+    def testGetPostsPaginatedWithTitle(self):
+        """ Paging through posts filtered by title """
+        postA = repository.create("Post with bells", "Just a test")
+        postB = repository.create("Post with whistles", "Just a test")
+        postC = repository.create("Post with bells and whistles", "Just a test")
+
+        response = self.client.get("/api/posts?title_like=bells&limit=1",
+            headers=[("Accept", "application/json")]
+        )
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]["title"], "Post with bells")
+
+        # The next link keeps the filter
+        url = urlparse(response.headers["Link"][1:].split(">")[0])
+        self.assertIn("title_like=bells", url.query)
+        response = self.client.get("{}?{}".format(url.path, url.query),
+            headers=[("Accept", "application/json")]
+        )
+        data = json.loads(response.data)
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]["title"], "Post with bells and whistles")
+        self.assertNotIn("Link", response.headers)
+
+    def testGetPostsInvalidCursor(self):
+        """ Paging with an invalid limit or cursor """
+        response = self.client.get("/api/posts?limit=0",
+            headers=[("Accept", "application/json")]
+        )
+        self.assertEqual(response.status_code, 400)
+        data = json.loads(response.data)
+        self.assertEqual(data["message"], "limit must be a positive integer")
+
+        response = self.client.get("/api/posts?after=notacursor",
+            headers=[("Accept", "application/json")]
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.mimetype, "application/json")
+
+    def testGetPostsStreamed(self):
+        """ Streaming posts as a JSON array """
+        postA = repository.create("Example Post A", "Just a test")
+        postB = repository.create("Example Post B", "Still a test")
+
+        response = self.client.get("/api/posts?stream=true",
+            headers=[("Accept", "application/json")]
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "application/json")
+        data = json.loads(response.data)
+        self.assertEqual([post["title"] for post in data],
+                         ["Example Post A", "Example Post B"])
+
+    def testGetEmptyPostsStreamed(self):
+        """ Streaming posts from an empty database """
+        response = self.client.get("/api/posts?stream=true",
+            headers=[("Accept", "application/json")]
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data), [])
+
+    def testGetPostsNDJSON(self):
+        """ Streaming posts as newline delimited JSON """
+        postA = repository.create("Example Post A", "Just a test")
+        postB = repository.create("Example Post B", "Still a test")
+
+        response = self.client.get("/api/posts",
+            headers=[("Accept", "application/x-ndjson")]
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        lines = response.data.splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(json.loads(lines[0])["title"], "Example Post A")
+        self.assertEqual(json.loads(lines[1])["title"], "Example Post B")
+
+    def testSearchPosts(self):
+        """ Searching posts, best match first """
+        postA = repository.create("Post with bells", "Just a test")
+        postB = repository.create("Post with whistles", "Another whistles test, whistles everywhere")
+        postC = repository.create("Post with bells and whistles", "Another bells test")
+
+        response = self.client.get("/api/posts?q=whistles",
+            headers=[("Accept", "application/json")]
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "application/json")
+        posts = json.loads(response.data)
+        self.assertEqual([post["title"] for post in posts],
+                         ["Post with whistles", "Post with bells and whistles"])
+
+    def testSearchPostsBlank(self):
+        """ A blank search is the same as no search """
+        postA = repository.create("Post with bells", "Just a test")
+        postB = repository.create("Post with whistles", "Just a test")
+
+        response = self.client.get("/api/posts?q=%20",
+            headers=[("Accept", "application/json")]
+        )
+        self.assertEqual(response.status_code, 200)
+        posts = json.loads(response.data)
+        self.assertEqual([post["title"] for post in posts],
+                         ["Post with bells", "Post with whistles"])
+
+        response = self.client.get("/api/posts/_count?q=%20",
+            headers=[("Accept", "application/json")]
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)["count"], 2)
+
+    def testSearchPostsAfterEdit(self):
+        """ Searching posts sees edits and deletions """
+        postA = repository.create("Post with bells", "Just a test")
+        postB = repository.create("Post with whistles", "Just a test")
+
+        repository.update(repository.post(postA.id), "Post with whistles too",
+                          "Just a test")
+        repository.delete(repository.post(postB.id))
+
+        response = self.client.get("/api/posts?q=whistles",
+            headers=[("Accept", "application/json")]
+        )
+        posts = json.loads(response.data)
+        self.assertEqual([post["title"] for post in posts],
+                         ["Post with whistles too"])
+
+    def testSearchPostsWithCursor(self):
+        """ Search results can't be paged with a cursor """
+        response = self.client.get("/api/posts?q=whistles&after=MQ==",
+            headers=[("Accept", "application/json")]
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def testSearchPostsWithLimit(self):
+        """ Limited search results have no link to a next page """
+        for i in range(3):
+            repository.create("Post with whistles {}".format(i), "Just a test")
+
+        response = self.client.get("/api/posts?q=whistles&limit=2",
+            headers=[("Accept", "application/json")]
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.data)), 2)
+        self.assertNotIn("Link", response.headers)
+
+    def testGetPostCached(self):
+        """ Getting a single post twice serves the second from the cache """
+        post = repository.create("Example Post", "Just a test")
+
+        hits = cache.stats()["hits"]
+        for i in range(2):
+            response = self.client.get("/api/posts/{}".format(post.id),
+                headers=[("Accept", "application/json")]
+            )
+            self.assertEqual(response.status_code, 200)
+            data = json.loads(response.data)
+            self.assertEqual(data["title"], "Example Post")
+        self.assertEqual(cache.stats()["hits"], hits + 1)
+
+        response = self.client.get("/api/cache",
+            headers=[("Accept", "application/json")]
+        )
+        stats = json.loads(response.data)
+        self.assertEqual(stats["hits"], hits + 1)
+        self.assertIn("misses", stats)
+        self.assertIn("evictions", stats)
+
+    def testPutPostInvalidatesCache(self):
+        """ Editing a post removes the cached copy """
+        post = repository.create("Example Post", "Just a test")
+        id = post.id
+
+        self.client.get("/api/posts/{}".format(id),
+            headers=[("Accept", "application/json")]
+        )
+        data = {
+            "title": "Updated Example Post",
+            "body": "Just an updated test"
+        }
+        self.client.put("/api/post/{}".format(id),
+            data=json.dumps(data),
+            content_type="application/json",
+            headers=[("Accept", "application/json")]
+        )
+
+        response = self.client.get("/api/posts/{}".format(id),
+            headers=[("Accept", "application/json")]
+        )
+        data = json.loads(response.data)
+        self.assertEqual(data["title"], "Updated Example Post")
+
+    def testDeletePostInvalidatesCache(self):
+        """ Deleting a post removes the cached copy """
+        post = repository.create("Example Post", "Just a test")
+        id = post.id
+
+        self.client.get("/api/posts/{}".format(id),
+            headers=[("Accept", "application/json")]
+        )
+        self.client.delete("/api/posts/{}".format(id),
+            headers=[("Accept", "application/json")]
+        )
+
+        response = self.client.get("/api/posts/{}".format(id),
+            headers=[("Accept", "application/json")]
+        )
+        self.assertEqual(response.status_code, 404)
+
+    def testGetPostNotModified(self):
+        """ Getting a post the client already has """
+        post = repository.create("Example Post", "Just a test")
+        url = "/api/posts/{}".format(post.id)
+
+        response = self.client.get(url, headers=[("Accept", "application/json")])
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers["ETag"]
+        last_modified = response.headers["Last-Modified"]
+
+        response = self.client.get(url,
+            headers=[("Accept", "application/json"), ("If-None-Match", etag)]
+        )
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, "")
+        self.assertEqual(response.headers["ETag"], etag)
+
+        response = self.client.get(url,
+            headers=[("Accept", "application/json"),
+                     ("If-Modified-Since", last_modified)]
+        )
+        self.assertEqual(response.status_code, 304)
+
+    def testGetPostModified(self):
+        """ Getting a post which has changed since the client's copy """
+        post = repository.create("Example Post", "Just a test")
+        url = "/api/posts/{}".format(post.id)
+
+        response = self.client.get(url, headers=[("Accept", "application/json")])
+        etag = response.headers["ETag"]
+
+        data = {
+            "title": "Updated Example Post",
+            "body": "Just an updated test"
+        }
+        response = self.client.put("/api/post/{}".format(post.id),
+            data=json.dumps(data),
+            content_type="application/json",
+            headers=[("Accept", "application/json")]
+        )
+        self.assertNotEqual(response.headers["ETag"], etag)
+
+        response = self.client.get(url,
+            headers=[("Accept", "application/json"), ("If-None-Match", etag)]
+        )
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertEqual(data["title"], "Updated Example Post")
+
+    def testGetPostsNotModified(self):
+        """ Getting a listing of posts the client already has """
+        postA = repository.create("Example Post A", "Just a test")
+        postB = repository.create("Example Post B", "Still a test")
+        idB = postB.id
+
+        response = self.client.get("/api/posts",
+            headers=[("Accept", "application/json")]
+        )
+        etag = response.headers["ETag"]
+
+        response = self.client.get("/api/posts",
+            headers=[("Accept", "application/json"), ("If-None-Match", etag)]
+        )
+        self.assertEqual(response.status_code, 304)
+
+        # A different query gets a different ETag
+        response = self.client.get("/api/posts?title_like=A",
+            headers=[("Accept", "application/json"), ("If-None-Match", etag)]
+        )
+        self.assertEqual(response.status_code, 200)
+
+        # Deleting a post changes the listing
+        self.client.delete("/api/posts/{}".format(idB),
+            headers=[("Accept", "application/json")]
+        )
+        response = self.client.get("/api/posts",
+            headers=[("Accept", "application/json"), ("If-None-Match", etag)]
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.data)), 1)
+
+    def testBulkPosts(self):
+        """ Creating, updating and deleting posts in one request """
+        postA = repository.create("Example Post A", "Just a test")
+        postB = repository.create("Example Post B", "Still a test")
+        idA, idB = postA.id, postB.id
+
+        data = [
+            {"op": "create", "title": "Example Post C", "body": "A new test"},
+            {"op": "update", "id": idA, "title": "Updated Example Post A",
+             "body": "Just an updated test"},
+            {"op": "delete", "id": idB},
+            {"op": "delete", "id": 100},
+            {"op": "create", "title": "Example Post D", "body": 32}
+        ]
+        response = self.client.post("/api/posts/_bulk",
+            data=json.dumps(data),
+            content_type="application/json",
+            headers=[("Accept", "application/json")]
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "application/json")
+        data = json.loads(response.data)
+        self.assertTrue(data["errors"])
+        statuses = [item["status"] for item in data["items"]]
+        self.assertEqual(statuses, [201, 200, 204, 404, 422])
+        self.assertEqual(data["items"][4]["message"], "32 is not of type 'string'")
+
+        posts = list(repository.export())
+        self.assertEqual([post.title for post in posts],
+                         ["Updated Example Post A", "Example Post C"])
+        self.assertEqual(posts[1].id, data["items"][0]["id"])
+        self.assertEqual(posts[0].version, 2)
+
+    def testBulkPostsNDJSON(self):
+        """ Creating posts from newline delimited JSON """
+        lines = [
+            json.dumps({"op": "create", "title": "Example Post A", "body": "Just a test"}),
+            "",
+            "not json",
+            json.dumps({"op": "create", "title": "Example Post B", "body": "Still a test"})
+        ]
+        response = self.client.post("/api/posts/_bulk",
+            data="\n".join(lines),
+            content_type="application/x-ndjson",
+            headers=[("Accept", "application/json")]
+        )
+
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        statuses = [item["status"] for item in data["items"]]
+        self.assertEqual(statuses, [201, 422, 201])
+
+        posts = list(repository.export())
+        self.assertEqual(len(posts), 2)
+
+    def testBulkCreateIgnoresId(self):
+        """ Posts created in bulk get their id from the server """
+        data = [{"op": "create", "id": 1000, "title": "Example Post A",
+                 "body": "Just a test"}]
+        response = self.client.post("/api/posts/_bulk",
+            data=json.dumps(data),
+            content_type="application/json",
+            headers=[("Accept", "application/json")]
+        )
+
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertEqual(data["items"][0]["status"], 201)
+        self.assertNotEqual(data["items"][0]["id"], 1000)
+
+    @sql_only
+    def testBulkPostsDatabaseError(self):
+        """ A failed transaction gives every operation in it a 500 """
+        post = repository.create("Example Post A", "Just a test")
+
+        def record_changes(connection, op, ids):
+            raise SQLAlchemyError("Broken")
+        original, models.record_changes = models.record_changes, record_changes
+        try:
+            data = [
+                {"op": "create", "title": "Example Post B", "body": "A new test"},
+                {"op": "update", "id": post.id, "title": "Updated Example Post A",
+                 "body": "Just an updated test"},
+                {"op": "delete", "id": 100}
+            ]
+            response = self.client.post("/api/posts/_bulk",
+                data=json.dumps(data),
+                content_type="application/json",
+                headers=[("Accept", "application/json")]
+            )
+        finally:
+            models.record_changes = original
+
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        statuses = [item["status"] for item in data["items"]]
+        self.assertEqual(statuses, [500, 500, 404])
+
+    def testBulkPostsNotArray(self):
+        """ Bulk operations must come as an array """
+        response = self.client.post("/api/posts/_bulk",
+            data=json.dumps({"op": "create"}),
+            content_type="application/json",
+            headers=[("Accept", "application/json")]
+        )
+
+        self.assertEqual(response.status_code, 422)
+        data = json.loads(response.data)
+        self.assertEqual(data["message"], "Request must contain an array of operations")
+
+    @sql_only
+    def testSessionRemovedAfterRequest(self):
+        """ Each request gets a fresh database session """
+        self.client.get("/api/posts", headers=[("Accept", "application/json")])
+        self.assertFalse(session.registry.has())
+
+    @sql_only
+    def testMetrics(self):
+        """ Timing the phases of a request """
+        post = repository.create("Example Post", "Just a test")
+
+        self.app.config["INSTRUMENTATION"] = True
+        try:
+            self.client.get("/api/posts", headers=[("Accept", "application/json")])
+        finally:
+            self.app.config["INSTRUMENTATION"] = False
+
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "text/plain")
+        for phase in ["accept", "query", "hydrate", "as_dictionary", "dumps"]:
+            self.assertIn('posts_phase_seconds_count{{phase="{}",route="posts_get"}} 1'
+                          .format(phase), response.data)
+        self.assertIn('posts_request_seconds_count{method="GET",route="posts_get",status="200"} 1',
+                      response.data)
+        self.assertIn('posts_sql_statements_total{route="posts_get"} 2',
+                      response.data)
+        self.assertIn("posts_cache_hits_total", response.data)
+
+    def testProfile(self):
+        """ Profiling a request which asks for it """
+        directory = tempfile.mkdtemp()
+        self.app.config.update(INSTRUMENTATION=True, PROFILE_DIR=directory,
+                               PROFILE_SECRET="secret")
+        try:
+            # Only a client which knows the secret can ask for a profile
+            self.client.get("/api/posts",
+                headers=[("Accept", "application/json"), ("X-Profile", "1")]
+            )
+            self.assertEqual(os.listdir(directory), [])
+            self.client.get("/api/posts",
+                headers=[("Accept", "application/json"), ("X-Profile", "secret")]
+            )
+            profiles = os.listdir(directory)
+        finally:
+            self.app.config.update(INSTRUMENTATION=False, PROFILE_SECRET=None)
+            shutil.rmtree(directory)
+
+        self.assertEqual(len(profiles), 1)
+        self.assertTrue(profiles[0].startswith("posts_get-"))
+
+    def testProfileWithoutSecret(self):
+        """ Without a secret the X-Profile header is ignored """
+        directory = tempfile.mkdtemp()
+        self.app.config.update(INSTRUMENTATION=True, PROFILE_DIR=directory)
+        try:
+            self.client.get("/api/posts",
+                headers=[("Accept", "application/json"), ("X-Profile", "1")]
+            )
+            profiles = os.listdir(directory)
+        finally:
+            self.app.config["INSTRUMENTATION"] = False
+            shutil.rmtree(directory)
+
+        self.assertEqual(profiles, [])
+
+    def testGetPostsFields(self):
+        """ Getting only some fields of posts """
+        postA = repository.create("Example Post A", "Just a test " * 20)
+        postB = repository.create("Example Post B", "Still a test")
+
+        response = self.client.get("/api/posts?fields=title,body_preview",
+            headers=[("Accept", "application/json")]
+        )
+
+        self.assertEqual(response.status_code, 200)
+        posts = json.loads(response.data)
+        self.assertEqual(sorted(posts[0].keys()), ["body_preview", "title"])
+        self.assertEqual(posts[0]["title"], "Example Post A")
+        self.assertEqual(posts[0]["body_preview"],
+                         ("Just a test " * 20)[:self.app.config["BODY_PREVIEW_LENGTH"]])
+        self.assertEqual(posts[1]["body_preview"], "Still a test")
+
+    def testGetPostsFieldsPaginated(self):
+        """ Paging through posts without asking for their ids """
+        posts = [repository.create("Post {}".format(i), "Just a test")
+                 for i in range(3)]
+
+        response = self.client.get("/api/posts?fields=title&limit=2",
+            headers=[("Accept", "application/json")]
+        )
+        self.assertEqual(json.loads(response.data),
+                         [{"title": "Post 0"}, {"title": "Post 1"}])
+        self.assertIn("Link", response.headers)
+
+    def testGetPostFields(self):
+        """ Getting only some fields of a single post """
+        post = repository.create("Example Post", "Just a test")
+        url = "/api/posts/{}".format(post.id)
+
+        response = self.client.get(url + "?fields=id,title",
+            headers=[("Accept", "application/json")]
+        )
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertEqual(data, {"id": post.id, "title": "Example Post"})
+        partial_etag = response.headers["ETag"]
+
+        response = self.client.get(url, headers=[("Accept", "application/json")])
+        self.assertNotEqual(response.headers["ETag"], partial_etag)
+        self.assertEqual(json.loads(response.data)["body"], "Just a test")
+
+    def testGetPostsUnknownField(self):
+        """ Asking for a field which doesn't exist """
+        response = self.client.get("/api/posts?fields=id,author",
+            headers=[("Accept", "application/json")]
+        )
+        self.assertEqual(response.status_code, 400)
+        data = json.loads(response.data)
+        self.assertEqual(data["message"], "Unknown field author")
+
+    def testCompressionRefused(self):
+        """ Encodings the client refuses with q=0 aren't used """
+        post = repository.create("Example Post", "Just a test " * 80)
+        for accept_encoding in ["gzip;q=0, identity", "identity, *;q=0"]:
+            response = self.client.get("/api/posts/{}".format(post.id),
+                headers=[("Accept", "application/json"),
+                         ("Accept-Encoding", accept_encoding)]
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn("Content-Encoding", response.headers)
+            self.assertEqual(json.loads(response.data)["body"], "Just a test " * 80)
+
+    def testGetPostCompressed(self):
+        """ Getting a large post gzipped """
+        post = repository.create("Example Post", "Just a test " * 80)
+        url = "/api/posts/{}".format(post.id)
+
+        hits = cache.stats()["hits"]
+        for i in range(2):
+            response = self.client.get(url,
+                headers=[("Accept", "application/json"),
+                         ("Accept-Encoding", "gzip")]
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers["Content-Encoding"], "gzip")
+            self.assertIn("Accept-Encoding", response.headers["Vary"])
+            data = json.loads(zlib.decompress(response.data, 16 + zlib.MAX_WBITS))
+            self.assertEqual(data["body"], "Just a test " * 80)
+
+        # The second request was served from the cached post and its
+        # compressed copy
+        self.assertEqual(cache.stats()["hits"], hits + 2)
+
+        # A compressed response only has a weak ETag, which still validates
+        etag = response.headers["ETag"]
+        self.assertTrue(etag.upper().startswith("W/"))
+        response = self.client.get(url,
+            headers=[("Accept", "application/json"),
+                     ("Accept-Encoding", "gzip"), ("If-None-Match", etag)]
+        )
+        self.assertEqual(response.status_code, 304)
+
+    def testGetSmallPostNotCompressed(self):
+        """ Small responses aren't worth compressing """
+        post = repository.create("Example Post", "Just a test")
+
+        response = self.client.get("/api/posts/{}".format(post.id),
+            headers=[("Accept", "application/json"), ("Accept-Encoding", "gzip")]
+        )
+        self.assertNotIn("Content-Encoding", response.headers)
+        self.assertEqual(json.loads(response.data)["body"], "Just a test")
+
+    def testGetPostsStreamedCompressed(self):
+        """ Streaming posts gzipped """
+        posts = [repository.create("Post {}".format(i), "Just a test")
+                 for i in range(50)]
+
+        response = self.client.get("/api/posts?stream=true",
+            headers=[("Accept", "application/json"), ("Accept-Encoding", "gzip")]
+        )
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        data = json.loads(zlib.decompress(response.data, 16 + zlib.MAX_WBITS))
+        self.assertEqual(len(data), 50)
+        self.assertEqual(response.get_etag()[1], True)
+
+    @sql_only
+    def testWriteBehind(self):
+        """ Creating and editing posts in write-behind mode """
+        self.app.config["WRITE_BEHIND"] = True
+        try:
+            data = {"title": "Example Post", "body": "Just a test"}
+            response = self.client.post("/api/posts",
+                data=json.dumps(data),
+                content_type="application/json",
+                headers=[("Accept", "application/json")]
+            )
+            self.assertEqual(response.status_code, 202)
+            id = json.loads(response.data)["id"]
+            status_url = urlparse(response.headers["Location"]).path
+
+            writes.flush()
+            response = self.client.get(status_url,
+                headers=[("Accept", "application/json")]
+            )
+            self.assertEqual(response.status_code, 200)
+            status = json.loads(response.data)
+            self.assertEqual(status["status"], "committed")
+            self.assertEqual(status["id"], id)
+
+            data = {"title": "Updated Example Post", "body": "Just an updated test"}
+            response = self.client.put("/api/post/{}".format(id),
+                data=json.dumps(data),
+                content_type="application/json",
+                headers=[("Accept", "application/json")]
+            )
+            self.assertEqual(response.status_code, 202)
+            writes.flush()
+        finally:
+            self.app.config["WRITE_BEHIND"] = False
+
+        response = self.client.get("/api/posts/{}".format(id),
+            headers=[("Accept", "application/json")]
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)["title"], "Updated Example Post")
+
+    def testWriteBehindQueueFull(self):
+        """ Writes are refused once the queue is full """
+        queue = WriteBehind(Session, max_size=1)
+        # Keep the background thread from emptying the queue
+        queue.start = lambda: None
+        queue.submit("create", 1, {"title": "Example Post", "body": "Just a test"})
+        self.assertRaises(QueueFull, queue.submit, "create", 2,
+                          {"title": "Example Post", "body": "Just a test"})
+
+    @sql_only
+    def testWriteBehindRetry(self):
+        """ A write which fails on its own doesn't change the others' status """
+        post = repository.create("Example Post A", "Just a test")
+
+        queue = WriteBehind(Session)
+        for offset, ticket in enumerate("abc"):
+            queue.add_status(ticket, post.id + offset)
+        queue.apply([
+            ("a", "create", post.id, {"title": "Duplicate", "body": "A test"}),
+            ("b", "create", post.id + 1, {"title": "Example Post B",
+                                          "body": "Still a test"}),
+            ("c", "update", post.id + 2, {"title": "Missing", "body": "A test"})
+        ])
+        self.assertEqual(queue.status("a")["status"], "failed")
+        self.assertEqual(queue.status("b")["status"], "committed")
+        self.assertEqual(queue.status("c")["status"], "failed")
+
+    @sql_only
+    def testWriteStatusShared(self):
+        """ Any worker can answer for a write, whichever one queued it """
+        queue = WriteBehind(Session)
+        # Keep the background thread from taking the write
+        queue.start = lambda: None
+        ticket = queue.submit("create", 1,
+                              {"title": "Example Post", "body": "Just a test"})
+
+        # A queue in another worker knows the write is pending, then that
+        # it was committed
+        other = WriteBehind(Session)
+        self.assertEqual(other.status(ticket), {"status": "pending", "id": 1})
+        queue.apply([queue.queue.get_nowait()])
+        self.assertEqual(other.status(ticket), {"status": "committed", "id": 1})
+
+    def testGetUnknownWrite(self):
+        """ Getting the status of a write which doesn't exist """
+        response = self.client.get("/api/writes/unknown",
+            headers=[("Accept", "application/json")]
+        )
+        self.assertEqual(response.status_code, 404)
+
+    def testCountPosts(self):
+        """ Counting posts as they are added and deleted """
+        postA = repository.create("Example Post A", "Just a test")
+        postB = repository.create("Example Post B", "Still a test")
+        idA = postA.id
+
+        response = self.client.get("/api/posts/_count",
+            headers=[("Accept", "application/json")]
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "application/json")
+        self.assertIn("max-age", response.headers["Cache-Control"])
+        data = json.loads(response.data)
+        self.assertEqual(data, {"count": 2, "approximate": False})
+
+        self.client.delete("/api/posts/{}".format(idA),
+            headers=[("Accept", "application/json")]
+        )
+        response = self.client.get("/api/posts/_count",
+            headers=[("Accept", "application/json")]
+        )
+        self.assertEqual(json.loads(response.data)["count"], 1)
+
+    def testCountPostsFiltered(self):
+        """ Counting only the posts which match a filter """
+        postA = repository.create("Post with bells", "Just a test")
+        postB = repository.create("Post with whistles", "Still a test")
+        postC = repository.create("Post with bells and whistles",
+                                  "Another test")
+
+        response = self.client.get("/api/posts/_count?title_like=whistles",
+            headers=[("Accept", "application/json")]
+        )
+        self.assertEqual(json.loads(response.data)["count"], 2)
+
+        response = self.client.get("/api/posts/_count?q=bells",
+            headers=[("Accept", "application/json")]
+        )
+        self.assertEqual(json.loads(response.data)["count"], 2)
+
+    def testCountPostsAfterBulk(self):
+        """ Bulk creates and deletes keep the count up to date """
+        post = repository.create("Example Post A", "Just a test")
+        id = post.id
+
+        data = [
+            {"op": "create", "title": "Example Post B", "body": "Still a test"},
+            {"op": "create", "title": "Example Post C", "body": "A new test"},
+            {"op": "delete", "id": id}
+        ]
+        self.client.post("/api/posts/_bulk",
+            data=json.dumps(data),
+            content_type="application/json",
+            headers=[("Accept", "application/json")]
+        )
+
+        response = self.client.get("/api/posts/_count",
+            headers=[("Accept", "application/json")]
+        )
+        self.assertEqual(json.loads(response.data)["count"], 2)
+
+    def testCountPostsNotModified(self):
+        """ Getting a count which hasn't changed """
+        response = self.client.get("/api/posts/_count",
+            headers=[("Accept", "application/json")]
+        )
+        etag = response.headers["ETag"]
+
+        response = self.client.get("/api/posts/_count",
+            headers=[("Accept", "application/json"), ("If-None-Match", etag)]
+        )
+        self.assertEqual(response.status_code, 304)
+
+    def testGetChanges(self):
+        """ Getting the changes made to posts """
+        postA = repository.create("Example Post A", "Just a test")
+        postB = repository.create("Example Post B", "Still a test")
+        idA, idB = postA.id, postB.id
+
+        data = {"title": "Edited Post A", "body": "Just an edited test"}
+        self.client.put("/api/post/{}".format(idA),
+            data=json.dumps(data),
+            content_type="application/json",
+            headers=[("Accept", "application/json")]
+        )
+        self.client.delete("/api/posts/{}".format(idB),
+            headers=[("Accept", "application/json")]
+        )
+
+        response = self.client.get("/api/posts/_changes",
+            headers=[("Accept", "application/json")]
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "application/json")
+        data = json.loads(response.data)
+        changes = data["changes"]
+        self.assertEqual([(change["op"], change["id"]) for change in changes],
+                         [("create", idA), ("create", idB),
+                          ("update", idA), ("delete", idB)])
+        self.assertEqual(changes[2]["post"]["title"], "Edited Post A")
+        self.assertEqual(changes[1]["post"], None)
+        self.assertEqual(changes[3]["post"], None)
+        self.assertEqual(data["since"], changes[-1]["seq"])
+
+        # Nothing has changed since the last change
+        response = self.client.get("/api/posts/_changes?since={}".format(data["since"]),
+            headers=[("Accept", "application/json")]
+        )
+        data = json.loads(response.data)
+        self.assertEqual(data["changes"], [])
+        self.assertEqual(data["since"], changes[-1]["seq"])
+
+    @sql_only
+    def testChangesCommitInOrder(self):
+        """ Writers take the counter row lock before numbering their changes """
+        post = repository.create("Example Post A", "Just a test")
+        statements = []
+        def before_execute(connection, cursor, statement, parameters,
+                           context, executemany):
+            statements.append(statement.split()[:3])
+        database = get_database(self.app)
+        event.listen(database.engine, "before_cursor_execute", before_execute)
+        try:
+            self.client.put("/api/post/{}".format(post.id),
+                data=json.dumps({"title": "Edited Post A", "body": "Just a test"}),
+                content_type="application/json",
+                headers=[("Accept", "application/json")]
+            )
+        finally:
+            event.remove(database.engine, "before_cursor_execute", before_execute)
+
+        insert = statements.index(["INSERT", "INTO", "post_changes"])
+        self.assertIn(["UPDATE", "counters", "SET"], statements[:insert])
+
+    def testGetChangesAfterBulk(self):
+        """ Bulk operations are written to the change feed """
+        post = repository.create("Example Post A", "Just a test")
+        id = post.id
+
+        data = [
+            {"op": "create", "title": "Example Post B", "body": "Still a test"},
+            {"op": "update", "id": id, "title": "Edited Post A",
+             "body": "Just an edited test"},
+            {"op": "delete", "id": id}
+        ]
+        response = self.client.post("/api/posts/_bulk",
+            data=json.dumps(data),
+            content_type="application/json",
+            headers=[("Accept", "application/json")]
+        )
+        idB = json.loads(response.data)["items"][0]["id"]
+
+        response = self.client.get("/api/posts/_changes?since=1",
+            headers=[("Accept", "application/json")]
+        )
+        changes = json.loads(response.data)["changes"]
+        self.assertEqual([(change["op"], change["id"]) for change in changes],
+                         [("create", idB), ("update", id), ("delete", id)])
+        self.assertEqual(changes[0]["post"]["title"], "Example Post B")
+
+    def testGetChangesEventStream(self):
+        """ Getting the changes as Server-Sent Events """
+        post = repository.create("Example Post", "Just a test")
+        id = post.id
+
+        response = self.client.get("/api/posts/_changes?wait=0",
+            headers=[("Accept", "text/event-stream"), ("Last-Event-ID", "0")]
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "text/event-stream")
+        event = response.data.strip().split("\n")
+        self.assertEqual(event[:2], ["id: 1", "event: create"])
+        change = json.loads(event[2][len("data: "):])
+        self.assertEqual(change["post"], {"id": id, "title": "Example Post",
+                                          "body": "Just a test"})
+
+        response = self.client.get("/api/posts/_changes?wait=0",
+            headers=[("Accept", "text/event-stream"), ("Last-Event-ID", "1")]
+        )
+        self.assertEqual(response.data, "")
+
+    def testGetChangesInvalidSince(self):
+        """ Getting changes since something which isn't a sequence number """
+        response = self.client.get("/api/posts/_changes?since=yesterday",
+            headers=[("Accept", "application/json")]
+        )
+        self.assertEqual(response.status_code, 400)
+        data = json.loads(response.data)
+        self.assertEqual(data["message"], "since must be a sequence number")
+
+    def testRateLimit(self):
+        """ Clients over their rate limit for a route get a 429 """
+        self.app.config["RATE_LIMITS"] = {"post_get": (1, 2)}
+        try:
+            statuses = []
+            for i in range(3):
+                response = self.client.get("/api/posts/1",
+                    headers=[("Accept", "application/json")]
+                )
+                statuses.append(response.status_code)
+            # Other routes aren't limited
+            other = self.client.get("/api/posts",
+                headers=[("Accept", "application/json")]
+            )
+        finally:
+            self.app.config["RATE_LIMITS"] = {}
+            self.app.extensions["buckets"].clear()
+
+        self.assertEqual(statuses, [404, 404, 429])
+        self.assertEqual(response.headers["Retry-After"], "1")
+        data = json.loads(response.data)
+        self.assertEqual(data["message"], "Too many requests")
+        self.assertEqual(other.status_code, 200)
+
+    def testConcurrencyLimit(self):
+        """ Requests to a route with no free slots get a 503 """
+        concurrency = ConcurrencyLimit(limit=1, queue_size=0)
+        self.app.extensions["concurrency"]["posts_get"] = concurrency
+        try:
+            concurrency.acquire(0)
+            response = self.client.get("/api/posts",
+                headers=[("Accept", "application/json")]
+            )
+            self.assertEqual(response.status_code, 503)
+            self.assertIn("Retry-After", response.headers)
+
+            concurrency.release()
+            response = self.client.get("/api/posts",
+                headers=[("Accept", "application/json")]
+            )
+            self.assertEqual(response.status_code, 200)
+            # The slot is given back once the request is over
+            self.assertEqual(concurrency.active, 0)
+        finally:
+            del self.app.extensions["concurrency"]["posts_get"]
+
     def tearDown(self):
         """ Test teardown """
         session.close()
+        cache.clear()
+        registry.clear()
         # Remove the tables and their data from the database
         Base.metadata.drop_all(engine)
+        self.context.pop()
+
+class TestMemoryAPI(TestAPI):
+    """ Tests for the posts API served from the in-memory storage backend """
+
+    def createApp(self):
+        class Config(TestingConfig):
+            STORAGE_BACKEND = "memory"
+        # A new app for each test, so that each starts with no posts
+        return create_app(Config)
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,67 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+# Configure our app to use the testing databse
+os.environ["CONFIG_PATH"] = "posts.config.TestingConfig"
+
+from posts import create_app
+from posts.config import TestingConfig
+from posts.database import get_database, engine
+from posts.migrations import migrate
+from posts.cache import cache
+
+class TestCreateApp(unittest.TestCase):
+    """ Tests for building apps with create_app """
+
+    def setUp(self):
+        """ Test setup """
+        self.directory = tempfile.mkdtemp()
+
+    def make_app(self, name):
+        """ An app with a database of its own """
+        class Config(TestingConfig):
+            DATABASE_URI = "sqlite:///{}/{}.db".format(self.directory, name)
+        return create_app(Config)
+
+    def testNoConnectionUntilUsed(self):
+        """ Building an app doesn't create its engine """
+        app = self.make_app("posts")
+        self.assertEqual(get_database(app)._engine, None)
+
+        with app.app_context():
+            migrate(engine)
+        self.assertNotEqual(get_database(app)._engine, None)
+
+    def testAppsAreIsolated(self):
+        """ Each app has its own database and cache """
+        appA = self.make_app("postsA")
+        appB = self.make_app("postsB")
+        for app in [appA, appB]:
+            with app.app_context():
+                migrate(engine)
+
+        response = appA.test_client().post("/api/posts",
+            data='{"title": "Example Post", "body": "Just a test"}',
+            content_type="application/json",
+            headers=[("Accept", "application/json")]
+        )
+        self.assertEqual(response.status_code, 201)
+
+        response = appB.test_client().get("/api/posts",
+            headers=[("Accept", "application/json")]
+        )
+        self.assertEqual(response.data, "[]")
+
+        with appA.app_context():
+            cacheA = cache._get_current_object()
+        with appB.app_context():
+            self.assertIsNot(cache._get_current_object(), cacheA)
+
+    def tearDown(self):
+        """ Test teardown """
+        shutil.rmtree(self.directory)
+
+if __name__ == "__main__":
+    unittest.main()
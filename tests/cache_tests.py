@@ -0,0 +1,78 @@
+import unittest
+import os
+import time
+
+# Configure our app to use the testing databse
+os.environ["CONFIG_PATH"] = "posts.config.TestingConfig"
+
+from posts import create_app
+from posts.config import TestingConfig
+from posts.cache import LRUCache, share_between_workers
+
+class TestLRUCache(unittest.TestCase):
+    """ Tests for the in-process post cache """
+
+    def testGetMissing(self):
+        """ Getting a key which was never set """
+        cache = LRUCache(max_size=2)
+        self.assertEqual(cache.get("a"), None)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def testGetSet(self):
+        """ Getting a key back after setting it """
+        cache = LRUCache(max_size=2)
+        cache.set("a", "A")
+        self.assertEqual(cache.get("a"), "A")
+        self.assertEqual(cache.stats()["hits"], 1)
+
+    def testEvictsLeastRecentlyUsed(self):
+        """ Going over max_size evicts the least recently used entry """
+        cache = LRUCache(max_size=2)
+        cache.set("a", "A")
+        cache.set("b", "B")
+        # Using a makes b the least recently used
+        cache.get("a")
+        cache.set("c", "C")
+
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("a"), "A")
+        self.assertEqual(cache.get("c"), "C")
+        self.assertEqual(cache.stats()["evictions"], 1)
+        self.assertEqual(cache.stats()["size"], 2)
+
+    def testExpires(self):
+        """ Entries older than the ttl are not returned """
+        cache = LRUCache(max_size=2, ttl=0.01)
+        cache.set("a", "A")
+        time.sleep(0.02)
+        self.assertEqual(cache.get("a"), None)
+
+    def testDelete(self):
+        """ Deleting an entry """
+        cache = LRUCache(max_size=2)
+        cache.set("a", "A")
+        cache.delete("a")
+        cache.delete("b")
+        self.assertEqual(cache.get("a"), None)
+
+class TestSharedCache(unittest.TestCase):
+    """ Tests for caching posts in several worker processes """
+
+    def testMemoryTTLLimited(self):
+        """ Memory caches keep entries briefly when there are several workers """
+        app = create_app()
+        share_between_workers(app)
+        self.assertEqual(app.extensions["cache"].ttl,
+                         app.config["CACHE_MEMORY_TTL"])
+
+    def testOtherBackendsUnchanged(self):
+        """ Caches which aren't kept in each process keep their CACHE_TTL """
+        class Config(TestingConfig):
+            CACHE_BACKEND = None
+            CACHE_TTL = 300
+        app = create_app(Config)
+        share_between_workers(app)
+        self.assertEqual(app.config["CACHE_TTL"], 300)
+
+if __name__ == "__main__":
+    unittest.main()
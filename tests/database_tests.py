@@ -0,0 +1,109 @@
+import unittest
+import os
+import time
+import shutil
+import tempfile
+import datetime
+import json
+
+# Configure our app to use the testing databse
+os.environ["CONFIG_PATH"] = "posts.config.TestingConfig"
+
+from flask import g
+from sqlalchemy import create_engine
+
+from posts import create_app
+from posts import models
+from posts.config import TestingConfig
+from posts.cache import cache, post_key
+from posts.database import (Base, ReplicaSet, session, wrote_recently,
+                            get_database)
+from posts.migrations import migrate
+
+app = create_app()
+
+class TestReplicas(unittest.TestCase):
+    """ Tests for routing reads to replicas """
+
+    def setUp(self):
+        """ Test setup """
+        self.directory = tempfile.mkdtemp()
+        self.replicas = [
+            create_engine("sqlite:///{}/replica{}.db".format(self.directory, i))
+            for i in range(2)
+        ]
+        # A replica whose database can never be opened
+        self.broken = create_engine("sqlite:///{}/missing/replica.db".format(self.directory))
+
+    def testRoundRobin(self):
+        """ Replicas are handed out in turn """
+        replicas = ReplicaSet(self.replicas, check_interval=10)
+        chosen = [replicas.choose() for i in range(4)]
+        self.assertEqual(chosen, self.replicas + self.replicas)
+
+    def testSkipsUnhealthy(self):
+        """ A replica which fails its health check is skipped """
+        replicas = ReplicaSet([self.broken] + self.replicas, check_interval=10)
+        chosen = [replicas.choose() for i in range(4)]
+        self.assertEqual(chosen, self.replicas + self.replicas)
+        self.assertFalse(replicas.healthy[self.broken])
+
+    def testNoHealthyReplicas(self):
+        """ With every replica down there is nothing to choose """
+        replicas = ReplicaSet([self.broken], check_interval=10)
+        self.assertEqual(replicas.choose(), None)
+
+    def testReadsGoToReplica(self):
+        """ Queries made while a replica is chosen are sent to it """
+        replica = self.replicas[0]
+        Base.metadata.create_all(replica)
+        replica.execute(models.Post.__table__.insert(),
+                        title="Replica Post", body="Just a test", version=1)
+
+        with app.test_request_context():
+            g.replica = replica
+            posts = session.query(models.Post).all()
+            self.assertEqual([post.title for post in posts], ["Replica Post"])
+
+    def testReplicaReadsNotCached(self):
+        """ Posts read from a replica aren't kept in the shared cache """
+        directory = self.directory
+        class Config(TestingConfig):
+            DATABASE_URI = "sqlite:///{}/primary.db".format(directory)
+            DATABASE_REPLICA_URIS = ["sqlite:///{}/replica0.db".format(directory)]
+        replica_app = create_app(Config)
+        for engine in [get_database(replica_app).engine, self.replicas[0]]:
+            migrate(engine)
+        self.replicas[0].execute(models.Post.__table__.insert(), id=1,
+                                 title="Stale Post", body="Just a test",
+                                 version=1, updated_at=datetime.datetime.utcnow())
+
+        response = replica_app.test_client().get("/api/posts/1",
+            headers=[("Accept", "application/json")])
+        self.assertEqual(json.loads(response.data)["title"], "Stale Post")
+        with replica_app.app_context():
+            self.assertEqual(cache.get(post_key(1)), None)
+        get_database(replica_app).dispose()
+
+    def testReadYourWrites(self):
+        """ Clients which wrote recently read from the primary """
+        cookie = "last_write={}".format(time.time())
+        with app.test_request_context(headers=[("Cookie", cookie)]):
+            self.assertTrue(wrote_recently())
+
+        cookie = "last_write={}".format(time.time() - 60)
+        with app.test_request_context(headers=[("Cookie", cookie)]):
+            self.assertFalse(wrote_recently())
+
+        with app.test_request_context():
+            self.assertFalse(wrote_recently())
+
+    def tearDown(self):
+        """ Test teardown """
+        session.remove()
+        for replica in self.replicas:
+            replica.dispose()
+        shutil.rmtree(self.directory)
+
+if __name__ == "__main__":
+    unittest.main()
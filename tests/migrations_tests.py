@@ -0,0 +1,152 @@
+import unittest
+import os
+import shutil
+import tempfile
+import importlib
+
+# Configure our app to use the testing databse
+os.environ["CONFIG_PATH"] = "posts.config.TestingConfig"
+
+from sqlalchemy import create_engine, inspect
+
+from posts.migrations import migrate, migrations, applied
+
+class TestMigrations(unittest.TestCase):
+    """ Tests for the schema migrations """
+
+    def setUp(self):
+        """ Test setup """
+        self.directory = tempfile.mkdtemp()
+        self.engine = create_engine("sqlite:///{}/posts.db".format(self.directory))
+
+    def testMigrateEmptyDatabase(self):
+        """ Every migration is applied to a new database, once """
+        versions = [version for version, module in migrations()]
+        self.assertEqual(migrate(self.engine), versions)
+        self.assertEqual(applied(self.engine), set(versions))
+        self.assertEqual(migrate(self.engine), [])
+
+        inspector = inspect(self.engine)
+        self.assertIn("created_at", [column["name"] for column
+                                     in inspector.get_columns("posts")])
+        indexes = [index["name"] for index in inspector.get_indexes("posts")]
+        for name in ["ix_posts_created_at", "ix_posts_updated_at"]:
+            self.assertIn(name, indexes)
+        self.assertNotIn("ix_posts_title", indexes)
+
+    def testMigrateToTarget(self):
+        """ Migrating only as far as a given version """
+        self.assertEqual(migrate(self.engine, target=1), [1])
+        inspector = inspect(self.engine)
+        self.assertNotIn("created_at", [column["name"] for column
+                                        in inspector.get_columns("posts")])
+
+    def testBackfillCreatedAt(self):
+        """ Existing posts are given a created_at and counted """
+        migrate(self.engine, target=1)
+        self.engine.execute("INSERT INTO posts (title, body, version, updated_at) "
+                            "VALUES ('Example Post', 'Just a test', 1, "
+                            "'2014-06-01 12:00:00')")
+        migrate(self.engine)
+
+        created_at = self.engine.execute("SELECT created_at FROM posts").scalar()
+        self.assertEqual(str(created_at), "2014-06-01 12:00:00")
+
+    def testRerunAfterFailure(self):
+        """ A migration which failed part way can be run again """
+        migrate(self.engine, target=1)
+        self.engine.execute("ALTER TABLE posts ADD COLUMN created_at TIMESTAMP")
+        self.engine.execute("CREATE INDEX ix_posts_title ON posts (title)")
+        versions = [version for version, module in migrations()]
+        self.assertEqual(migrate(self.engine), versions[1:])
+        # The title index a failed 0002 left behind is replaced by 0005
+        indexes = [index["name"] for index in inspect(self.engine).get_indexes("posts")]
+        self.assertNotIn("ix_posts_title", indexes)
+
+    def testBackfillInBatches(self):
+        """ Every post is backfilled however many batches it takes """
+        module = importlib.import_module("posts.migrations.0002_indexes")
+        migrate(self.engine, target=1)
+        for i in range(5):
+            self.engine.execute("INSERT INTO posts (title, body, version, updated_at) "
+                                "VALUES ('Example Post', 'Just a test', 1, "
+                                "'2014-06-01 12:00:00')")
+        batch_size, module.BACKFILL_BATCH_SIZE = module.BACKFILL_BATCH_SIZE, 2
+        try:
+            migrate(self.engine)
+        finally:
+            module.BACKFILL_BATCH_SIZE = batch_size
+
+        missing = self.engine.execute("SELECT count(*) FROM posts "
+                                      "WHERE created_at IS NULL").scalar()
+        self.assertEqual(missing, 0)
+
+    def testCountExistingPosts(self):
+        """ The post counter starts from the posts already in the table """
+        self.engine.execute("CREATE TABLE posts (id INTEGER PRIMARY KEY, "
+                            "title VARCHAR(128), body VARCHAR(1024), "
+                            "version INTEGER NOT NULL, updated_at DATETIME NOT NULL, "
+                            "search_vector TEXT)")
+        self.engine.execute("INSERT INTO posts (title, body, version, updated_at) "
+                            "VALUES ('Example Post', 'Just a test', 1, "
+                            "'2014-06-01 12:00:00')")
+        migrate(self.engine)
+
+        count = self.engine.execute("SELECT value FROM counters "
+                                    "WHERE name = 'posts'").scalar()
+        self.assertEqual(count, 1)
+
+    def testMigrateBaselineSchema(self):
+        """ Posts from before the later columns were added are brought up to date """
+        self.engine.execute("CREATE TABLE posts (id INTEGER PRIMARY KEY, "
+                            "title VARCHAR(128), body VARCHAR(1024))")
+        self.engine.execute("INSERT INTO posts (title, body) "
+                            "VALUES ('Example Post', 'Just a test')")
+        migrate(self.engine)
+
+        version, updated_at, created_at = self.engine.execute(
+            "SELECT version, updated_at, created_at FROM posts").first()
+        self.assertEqual(version, 1)
+        self.assertNotEqual(updated_at, None)
+        self.assertEqual(created_at, updated_at)
+
+        # The existing post is indexed for search, and new ones are too
+        self.engine.execute("INSERT INTO posts (title, body, version, updated_at) "
+                            "VALUES ('Another Post', 'Still a test', 1, "
+                            "'2014-06-01 12:00:00')")
+        rows = self.engine.execute("SELECT rowid FROM posts_fts "
+                                   "WHERE posts_fts MATCH 'test' ORDER BY rowid")
+        self.assertEqual([row[0] for row in rows], [1, 2])
+
+    def testBaselineBackfilledInBatches(self):
+        """ Existing posts are filled in after the columns are added, in batches """
+        module = importlib.import_module("posts.migrations.0003_backfill")
+        self.engine.execute("CREATE TABLE posts (id INTEGER PRIMARY KEY, "
+                            "title VARCHAR(128), body VARCHAR(1024))")
+        for i in range(5):
+            self.engine.execute("INSERT INTO posts (title, body) "
+                                "VALUES ('Example Post', 'Just a test')")
+
+        # Adding the columns doesn't write to every post
+        migrate(self.engine, target=1)
+        missing = self.engine.execute("SELECT count(*) FROM posts "
+                                      "WHERE updated_at IS NULL").scalar()
+        self.assertEqual(missing, 5)
+
+        batch_size, module.BACKFILL_BATCH_SIZE = module.BACKFILL_BATCH_SIZE, 2
+        try:
+            migrate(self.engine)
+        finally:
+            module.BACKFILL_BATCH_SIZE = batch_size
+
+        missing = self.engine.execute("SELECT count(*) FROM posts WHERE "
+                                      "updated_at IS NULL OR created_at IS NULL").scalar()
+        self.assertEqual(missing, 0)
+
+    def tearDown(self):
+        """ Test teardown """
+        self.engine.dispose()
+        shutil.rmtree(self.directory)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+import unittest
+import os
+import time
+import threading
+
+# Configure our app to use the testing databse
+os.environ["CONFIG_PATH"] = "posts.config.TestingConfig"
+
+from posts.ratelimit import MemoryBuckets, ConcurrencyLimit
+
+class TestMemoryBuckets(unittest.TestCase):
+    """ Tests for the in-process token buckets """
+
+    def testBurst(self):
+        """ A full bucket allows a burst of requests, then makes clients wait """
+        buckets = MemoryBuckets()
+        self.assertEqual(buckets.take("a", 1, 2), 0)
+        self.assertEqual(buckets.take("a", 1, 2), 0)
+        wait = buckets.take("a", 1, 2)
+        self.assertTrue(0 < wait <= 1)
+
+    def testRefill(self):
+        """ Tokens come back at the bucket's rate """
+        buckets = MemoryBuckets()
+        self.assertEqual(buckets.take("a", 20, 1), 0)
+        self.assertTrue(buckets.take("a", 20, 1) > 0)
+        time.sleep(0.06)
+        self.assertEqual(buckets.take("a", 20, 1), 0)
+
+    def testSeparateKeys(self):
+        """ Each key has a bucket of its own """
+        buckets = MemoryBuckets()
+        self.assertEqual(buckets.take("a", 1, 1), 0)
+        self.assertEqual(buckets.take("b", 1, 1), 0)
+        self.assertTrue(buckets.take("a", 1, 1) > 0)
+
+    def testMaxSize(self):
+        """ Buckets beyond max_size are forgotten, least recently used first """
+        buckets = MemoryBuckets(max_size=2)
+        for key in ["a", "b", "c"]:
+            buckets.take(key, 1, 1)
+        self.assertEqual(list(buckets.buckets), ["b", "c"])
+
+class TestConcurrencyLimit(unittest.TestCase):
+    """ Tests for capping the requests in progress on a route """
+
+    def testLimit(self):
+        """ Slots run out once limit requests hold them """
+        concurrency = ConcurrencyLimit(limit=2, queue_size=0)
+        self.assertTrue(concurrency.acquire(0))
+        self.assertTrue(concurrency.acquire(0))
+        self.assertFalse(concurrency.acquire(0))
+        concurrency.release()
+        self.assertTrue(concurrency.acquire(0))
+
+    def testWaitForSlot(self):
+        """ A queued request gets the slot another one gives back """
+        concurrency = ConcurrencyLimit(limit=1, queue_size=1)
+        concurrency.acquire(0)
+        timer = threading.Timer(0.05, concurrency.release)
+        timer.start()
+        self.assertTrue(concurrency.acquire(1))
+        timer.join()
+
+    def testWaitTimesOut(self):
+        """ A queued request gives up once its wait is over """
+        concurrency = ConcurrencyLimit(limit=1, queue_size=1)
+        concurrency.acquire(0)
+        start = time.time()
+        self.assertFalse(concurrency.acquire(0.05))
+        self.assertTrue(time.time() - start >= 0.05)
+        self.assertEqual(concurrency.waiting, 0)
+
+    def testQueueFull(self):
+        """ Requests beyond the queue are turned away without waiting """
+        concurrency = ConcurrencyLimit(limit=1, queue_size=0)
+        concurrency.acquire(0)
+        start = time.time()
+        self.assertFalse(concurrency.acquire(1))
+        self.assertTrue(time.time() - start < 0.5)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,139 @@
+import unittest
+import os
+import json
+import shutil
+import tempfile
+from StringIO import StringIO
+
+# Configure our app to use the testing databse
+os.environ["CONFIG_PATH"] = "posts.config.TestingConfig"
+
+from posts import create_app
+from posts.config import TestingConfig
+from posts.database import Base, engine, session
+from posts.migrations import migrate
+from posts.repository import (MemoryRepository, ReadOnly, repository,
+                              write_snapshot)
+
+class TestMemoryRepository(unittest.TestCase):
+    """ Tests for the in-memory storage backend """
+
+    def setUp(self):
+        """ Test setup """
+        self.repository = MemoryRepository()
+        for title, body in [("Example Post A", "Just a test"),
+                            ("Example Post B", "Still a test"),
+                            ("Another one", "Testing, testing")]:
+            self.repository.create(title, body)
+
+    def ids(self, **filters):
+        rows = self.repository.list(("id",), **filters)
+        return [row.id for row in rows]
+
+    def testList(self):
+        """ Posts are listed in id order, after the cursor """
+        self.assertEqual(self.ids(), [1, 2, 3])
+        self.assertEqual(self.ids(after=1, limit=1), [2])
+
+    def testFilter(self):
+        """ Filters match whole and partial words anywhere in the text """
+        self.assertEqual(self.ids(title_like="Example Post"), [1, 2])
+        self.assertEqual(self.ids(title_like="ple Po"), [1, 2])
+        self.assertEqual(self.ids(title_like="Post B"), [2])
+        self.assertEqual(self.ids(body_like="test"), [1, 2, 3])
+        self.assertEqual(self.ids(body_like="ing, te"), [3])
+        self.assertEqual(self.ids(title_like="Example", body_like="Still"), [2])
+        self.assertEqual(self.ids(title_like="Missing"), [])
+
+    def testSearch(self):
+        """ Searches match posts with every term in the title or body """
+        self.assertEqual(self.ids(q="Example Still"), [2])
+        self.assertEqual(self.ids(q="one"), [3])
+
+    def testIndexFollowsChanges(self):
+        """ Edited and deleted posts are found by their new words only """
+        repository = self.repository
+        repository.update(repository.post(1), "Edited", "Just a test")
+        self.assertEqual(self.ids(title_like="Example"), [2])
+        self.assertEqual(self.ids(title_like="Edited"), [1])
+        self.assertEqual(repository.post(1).version, 2)
+
+        repository.delete(repository.post(2))
+        self.assertEqual(self.ids(body_like="test"), [1, 3])
+        self.assertEqual(repository.count(), (2, False))
+        self.assertEqual([change["op"] for change in repository.changes(0, 10)],
+                         ["create", "create", "create", "update", "delete"])
+
+    def testIdsNotReused(self):
+        """ A new post never gets the id of a deleted one """
+        self.repository.delete(self.repository.post(3))
+        self.assertEqual(self.repository.create("Title", "Body").id, 4)
+
+    def testFields(self):
+        """ Rows hold the requested fields, then the id """
+        self.repository.preview_length = 4
+        row = self.repository.get(2, ("body_preview",))
+        self.assertEqual(tuple(row)[:2], ("Stil", 2))
+        self.assertEqual(row.version, 1)
+        self.assertEqual(self.repository.get(4, ("id",)), None)
+
+    def testSnapshot(self):
+        """ A snapshot loads into a read-only copy of the posts """
+        stream = StringIO()
+        write_snapshot(self.repository, stream)
+
+        replica = MemoryRepository(read_only=True)
+        replica.load(StringIO(stream.getvalue()).readlines())
+        self.assertEqual([post.as_dictionary() for post in replica.export()],
+                         [post.as_dictionary() for post in self.repository.export()])
+        self.assertEqual(replica.post(1).updated_at,
+                         self.repository.post(1).updated_at)
+        self.assertEqual([row.id for row in replica.list(("id",), "Post")], [1, 2])
+        self.assertRaises(ReadOnly, replica.create, "Title", "Body")
+
+class TestSnapshotReplica(unittest.TestCase):
+    """ Tests for serving posts from a snapshot of the database """
+
+    def setUp(self):
+        """ Test setup """
+        self.directory = tempfile.mkdtemp()
+        self.app = create_app()
+        self.context = self.app.app_context()
+        self.context.push()
+        migrate(engine)
+
+    def testReplica(self):
+        """ A replica serves the posts in the snapshot and refuses writes """
+        repository.create("Example Post A", "Just a test")
+        repository.create("Example Post B", "Still a test")
+
+        path = os.path.join(self.directory, "posts.ndjson")
+        with open(path, "w") as stream:
+            write_snapshot(repository, stream)
+
+        class Config(TestingConfig):
+            STORAGE_BACKEND = "memory"
+            STORAGE_SNAPSHOT = path
+        client = create_app(Config).test_client()
+
+        response = client.get("/api/posts?title_like=Post B",
+            headers=[("Accept", "application/json")])
+        data = json.loads(response.data)
+        self.assertEqual([post["title"] for post in data], ["Example Post B"])
+
+        response = client.post("/api/posts",
+            data=json.dumps({"title": "Example Post C", "body": "A new test"}),
+            content_type="application/json",
+            headers=[("Accept", "application/json")]
+        )
+        self.assertEqual(response.status_code, 405)
+
+    def tearDown(self):
+        """ Test teardown """
+        session.close()
+        Base.metadata.drop_all(engine)
+        self.context.pop()
+        shutil.rmtree(self.directory)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,172 @@
+import unittest
+import os
+import json
+import shutil
+import tempfile
+
+# Configure our app to use the testing databse
+os.environ["CONFIG_PATH"] = "posts.config.TestingConfig"
+
+from posts import create_app, models
+from posts.config import TestingConfig
+from posts.database import get_database, Session
+from posts.migrations import migrate
+
+class TestSharding(unittest.TestCase):
+    """ Tests for spreading posts across several databases """
+
+    def setUp(self):
+        """ Test setup """
+        self.directory = tempfile.mkdtemp()
+        directory = self.directory
+
+        class Config(TestingConfig):
+            DATABASE_URI = "sqlite:///{}/primary.db".format(directory)
+            DATABASE_SHARD_URIS = [
+                "sqlite:///{}/shard1.db".format(directory),
+                "sqlite:///{}/shard2.db".format(directory)
+            ]
+            SHARD_ID_BLOCK_SIZE = 5
+
+        self.app = create_app(Config)
+        self.client = self.app.test_client()
+        self.database = get_database(self.app)
+        for engine in self.database.shards:
+            migrate(engine)
+
+    def createPost(self, title, body):
+        response = self.client.post("/api/posts",
+            data=json.dumps({"title": title, "body": body}),
+            content_type="application/json",
+            headers=[("Accept", "application/json")]
+        )
+        self.assertEqual(response.status_code, 201)
+        return json.loads(response.data)["id"]
+
+    def shardIds(self):
+        """ The ids of the posts on each shard """
+        ids = []
+        for engine in self.database.shards:
+            session = Session(bind=engine)
+            ids.append(set(id for id, in session.query(models.Post.id)))
+            session.close()
+        return ids
+
+    def testPostsLandOnTheirShard(self):
+        """ Each post is written to the shard its id maps to """
+        ids = [self.createPost("Post {}".format(i), "Body") for i in range(12)]
+        self.assertEqual(len(set(ids)), 12)
+
+        shard_ids = self.shardIds()
+        self.assertEqual(set.union(*shard_ids), set(ids))
+        with self.app.app_context():
+            for index, engine in enumerate(self.database.shards):
+                for id in shard_ids[index]:
+                    self.assertIs(self.database.shard_for(id), engine)
+
+    def testGetEditDeletePost(self):
+        """ Requests about one post go to its shard """
+        ids = [self.createPost("Post {}".format(i), "Body") for i in range(6)]
+
+        for id in ids:
+            response = self.client.get("/api/posts/{}".format(id),
+                headers=[("Accept", "application/json")])
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(json.loads(response.data)["id"], id)
+
+        response = self.client.put("/api/post/{}".format(ids[3]),
+            data=json.dumps({"title": "Edited", "body": "Body"}),
+            content_type="application/json",
+            headers=[("Accept", "application/json")]
+        )
+        self.assertEqual(response.status_code, 201)
+        response = self.client.get("/api/posts/{}".format(ids[3]),
+            headers=[("Accept", "application/json")])
+        self.assertEqual(json.loads(response.data)["title"], "Edited")
+
+        response = self.client.delete("/api/posts/{}".format(ids[4]),
+            headers=[("Accept", "application/json")])
+        self.assertEqual(response.status_code, 204)
+        response = self.client.get("/api/posts/{}".format(ids[4]),
+            headers=[("Accept", "application/json")])
+        self.assertEqual(response.status_code, 404)
+
+    def testListingMergesShards(self):
+        """ Listings are merged from every shard in id order """
+        ids = [self.createPost("Post {}".format(i), "Body") for i in range(9)]
+        self.assertTrue(all(self.shardIds()))
+
+        response = self.client.get("/api/posts",
+            headers=[("Accept", "application/json")])
+        self.assertEqual([post["id"] for post in json.loads(response.data)],
+                         sorted(ids))
+
+        response = self.client.get("/api/posts?limit=4",
+            headers=[("Accept", "application/json")])
+        self.assertEqual([post["id"] for post in json.loads(response.data)],
+                         sorted(ids)[:4])
+        self.assertIn('rel="next"', response.headers["Link"])
+
+    def testCount(self):
+        """ Counts add up the posts on every shard """
+        for i in range(7):
+            self.createPost("Post {}".format(i), "Body")
+
+        response = self.client.get("/api/posts/_count",
+            headers=[("Accept", "application/json")])
+        self.assertEqual(json.loads(response.data)["count"], 7)
+
+        response = self.client.get("/api/posts/_count?title_like=Post 1",
+            headers=[("Accept", "application/json")])
+        self.assertEqual(json.loads(response.data)["count"], 1)
+
+    def testBulk(self):
+        """ Bulk operations are applied on the shard of each post """
+        ids = [self.createPost("Post {}".format(i), "Body") for i in range(3)]
+
+        operations = [{"op": "create", "title": "New", "body": "Body"}
+                      for i in range(4)]
+        operations.append({"op": "update", "id": ids[0],
+                           "title": "Updated", "body": "Body"})
+        operations.append({"op": "delete", "id": ids[1]})
+        response = self.client.post("/api/posts/_bulk",
+            data=json.dumps(operations),
+            content_type="application/json",
+            headers=[("Accept", "application/json")]
+        )
+        self.assertEqual(response.status_code, 200)
+        results = json.loads(response.data)["items"]
+        self.assertEqual([result["status"] for result in results],
+                         [201, 201, 201, 201, 200, 204])
+
+        created = [result["id"] for result in results[:4]]
+        self.assertEqual(set.union(*self.shardIds()),
+                         set(created) | set([ids[0], ids[2]]))
+
+        response = self.client.get("/api/posts/_count",
+            headers=[("Accept", "application/json")])
+        self.assertEqual(json.loads(response.data)["count"], 6)
+
+    def testNoChangeFeed(self):
+        """ The change feed isn't available across shards """
+        response = self.client.get("/api/posts/_changes",
+            headers=[("Accept", "application/json")])
+        self.assertEqual(response.status_code, 501)
+
+    def testFanOutWorkers(self):
+        """ Fan out threads are shared, so there are enough for every request """
+        pool_size = (self.app.config["DATABASE_POOL_SIZE"] +
+                     self.app.config["DATABASE_MAX_OVERFLOW"])
+        self.assertEqual(self.database.executor._max_workers, 3 * pool_size)
+
+        self.app.config["SHARD_FAN_OUT_WORKERS"] = 4
+        self.database.dispose()
+        self.assertEqual(self.database.executor._max_workers, 4)
+
+    def tearDown(self):
+        """ Test teardown """
+        self.database.dispose()
+        shutil.rmtree(self.directory)
+
+if __name__ == "__main__":
+    unittest.main()